@@ -0,0 +1,78 @@
+"""Microbenchmark of the json encoder backends on typical record shapes.
+
+    python benchmarks/bench_json_encoders.py --rows 20000
+"""
+
+import argparse
+import random
+import string
+import time
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+
+from bson import ObjectId
+
+from target_s3.formats.json_encoder import ENCODERS, get_encoder
+
+
+def text(k: int = 12) -> str:
+    return "".join(random.choices(string.ascii_letters, k=k))
+
+
+def flat_record() -> dict:
+    return {
+        f"col_{i}": random.randint(0, 1 << 30) if i % 2 else text() for i in range(20)
+    }
+
+
+def typed_record() -> dict:
+    return {
+        "_id": ObjectId(),
+        "amount": Decimal(f"{random.randint(0, 10 ** 8)}.{random.randint(0, 99):02}"),
+        "updated_at": datetime(2023, 1, 1, tzinfo=timezone.utc)
+        + timedelta(seconds=random.randint(0, 10**7)),
+        "name": text(),
+        "active": random.random() < 0.5,
+    }
+
+
+def nested_record() -> dict:
+    return {
+        "id": random.randint(0, 1 << 30),
+        "address": {"city": text(), "zip": text(5), "geo": [random.random()] * 2},
+        "tags": [text(6) for _ in range(5)],
+        "orders": [{"sku": text(8), "qty": random.randint(1, 9)} for _ in range(3)],
+    }
+
+
+SHAPES = {"flat": flat_record, "typed": typed_record, "nested": nested_record}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    for shape, make in SHAPES.items():
+        records = [make() for _ in range(args.rows)]
+        for name in ENCODERS[1:]:
+            try:
+                encode = get_encoder(name)
+            except ImportError as e:
+                print(f"{shape:>7} {name:>10}: skipped, {e}")
+                continue
+            timings = []
+            for _ in range(args.repeat):
+                start = time.perf_counter()
+                size = sum(len(encode(record)) for record in records)
+                timings.append(time.perf_counter() - start)
+            elapsed = min(timings)
+            print(
+                f"{shape:>7} {name:>10}: {args.rows / elapsed:>12,.0f} records/s "
+                f"{size / elapsed / 1e6:>8.1f} MB/s"
+            )
+
+
+if __name__ == "__main__":
+    main()
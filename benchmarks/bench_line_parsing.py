@@ -0,0 +1,96 @@
+"""Benchmark Singer line parsing in Targets3.deserialize_json.
+
+Compares the target's parser with the former per-line behaviour: a config
+lookup and json.loads with Decimal floats for every line.
+
+    python benchmarks/bench_line_parsing.py --rows 100000
+"""
+
+import argparse
+import decimal
+import json
+import random
+import string
+import time
+
+from target_s3.target import Targets3
+
+CONFIG = {
+    "format": {"format_type": "jsonl"},
+    "cloud_provider": {
+        "cloud_provider_type": "aws",
+        "aws": {
+            "aws_access_key_id": "benchmark",
+            "aws_secret_access_key": "benchmark",
+            "aws_region": "us-east-1",
+            "aws_bucket": "benchmark",
+        },
+    },
+}
+
+
+def text(k: int = 12) -> str:
+    return "".join(random.choices(string.ascii_letters, k=k))
+
+
+def make_lines(rows: int, float_share: float) -> list:
+    """Returns RECORD lines, `float_share` of them holding float values."""
+    lines = []
+    for i in range(rows):
+        record = {
+            "id": i,
+            "name": text(),
+            "email": f"{text(8)}@example.com",
+            "updated_at": "2023-01-02T03:04:05.678000+00:00",
+            "tags": [text(5) for _ in range(3)],
+            "active": i % 2 == 0,
+        }
+        if random.random() < float_share:
+            record["amount"] = round(random.random() * 1000, 2)
+        lines.append(json.dumps({"type": "RECORD", "stream": "s", "record": record}))
+    return lines
+
+
+def former_deserialize_json(config: dict, line: str) -> dict:
+    format = config.get("format", None)
+    format_parquet = format.get("format_parquet", None)
+    if format_parquet and format_parquet.get("get_schema_from_tap", False):
+        return json.loads(line)
+    return json.loads(line, parse_float=decimal.Decimal)
+
+
+def best_of(repeat: int, fn, lines: list) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            fn(line)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    target = Targets3(config=CONFIG)
+    for float_share in (0.0, 0.1, 1.0):
+        lines = make_lines(args.rows, float_share)
+        before = best_of(
+            args.repeat,
+            lambda line: former_deserialize_json(target.config, line),
+            lines,
+        )
+        after = best_of(args.repeat, target.deserialize_json, lines)
+        print(
+            f"float lines {float_share:>4.0%}: "
+            f"former {args.rows / before:>10,.0f} lines/s, "
+            f"deserialize_json {args.rows / after:>10,.0f} lines/s "
+            f"({before / after:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
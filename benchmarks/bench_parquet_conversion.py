@@ -0,0 +1,125 @@
+"""Benchmark record-to-arrow conversion of FormatParquet on wide streams.
+
+Compares FormatParquet.create_dataframe with the former column-by-column
+conversion that sanitized every value, with and without a tap schema.
+
+    python benchmarks/bench_parquet_conversion.py --columns 250 --rows 10000
+"""
+
+import argparse
+import logging
+import random
+import string
+import time
+from datetime import datetime, timezone
+
+from pyarrow import Table
+
+from target_s3.formats.format_parquet import FormatParquet
+
+LOGGER = logging.getLogger("target-s3")
+CONFIG = {
+    "format": {"format_type": "parquet", "format_parquet": {}},
+    "cloud_provider": {
+        "cloud_provider_type": "aws",
+        "aws": {
+            "aws_access_key_id": "benchmark",
+            "aws_secret_access_key": "benchmark",
+            "aws_region": "us-east-1",
+            "aws_bucket": "benchmark",
+        },
+    },
+    "prefix": "benchmark",
+    "append_date_to_prefix": True,
+    "append_date_to_prefix_grain": "day",
+    "partition_name_enabled": False,
+    "append_date_to_filename": True,
+    "append_date_to_filename_grain": "day",
+}
+JSON_TYPES = [
+    {"type": ["integer", "null"]},
+    {"type": ["number", "null"]},
+    {"type": ["string", "null"]},
+    {"type": ["boolean", "null"]},
+]
+
+
+def make_stream(columns: int, rows: int) -> tuple:
+    """Returns a stream schema and records with `columns` mixed-type fields."""
+    properties = {f"col_{i}": JSON_TYPES[i % len(JSON_TYPES)] for i in range(columns)}
+    values = {
+        "integer": lambda: random.randint(0, 1 << 40),
+        "number": lambda: random.random() * 1000,
+        "string": lambda: "".join(random.choices(string.ascii_letters, k=12)),
+        "boolean": lambda: random.random() < 0.5,
+    }
+    generators = [values[p["type"][0]] for p in properties.values()]
+    records = [
+        {name: gen() for name, gen in zip(properties, generators)} for _ in range(rows)
+    ]
+    return {"type": "object", "properties": properties}, records
+
+
+def column_by_column(format_parquet: FormatParquet, schema=None) -> Table:
+    """The conversion create_dataframe used before, kept as the reference."""
+    if schema is not None:
+        fields = set(schema.names)
+    else:
+        fields = set()
+        for d in format_parquet.records:
+            fields = fields.union(d.keys())
+    input = {
+        f: [format_parquet.sanitize(row.get(f)) for row in format_parquet.records]
+        for f in fields
+    }
+    return Table.from_pydict(mapping=input, schema=schema)
+
+
+def best_of(repeat: int, fn) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--columns", type=int, default=250)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    stream_schema, records = make_stream(args.columns, args.rows)
+    context = {
+        "stream_name": "benchmark",
+        "logger": LOGGER,
+        "stream_schema": stream_schema,
+        "stream_cache": {},
+        "batch_start_time": datetime.now(tz=timezone.utc),
+    }
+    for get_schema_from_tap in (False, True):
+        config = dict(
+            CONFIG,
+            format={
+                "format_type": "parquet",
+                "format_parquet": {"get_schema_from_tap": get_schema_from_tap},
+            },
+        )
+        format_parquet = FormatParquet(config, context)
+        format_parquet.records = records
+        schema = format_parquet.create_schema() if get_schema_from_tap else None
+        before = best_of(args.repeat, lambda: column_by_column(format_parquet, schema))
+        after = best_of(args.repeat, format_parquet.create_dataframe)
+        print(
+            f"get_schema_from_tap={get_schema_from_tap} "
+            f"columns={args.columns} rows={args.rows}: "
+            f"column by column {args.rows / before:,.0f} records/s, "
+            f"create_dataframe {args.rows / after:,.0f} records/s "
+            f"({before / after:.1f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
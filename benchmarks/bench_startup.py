@@ -0,0 +1,99 @@
+"""Cold start time of the target, checked against budgets.
+
+    python benchmarks/bench_startup.py --repeat 5 --budget-ms 2000 --own-budget-ms 100
+
+Every run is a fresh interpreter: `-X importtime` reports what importing
+`Targets3` costs, and `--about` is timed end to end. Exits non-zero when a
+budget is exceeded or a module that should load on demand is imported at
+start, so it can guard CI.
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# imported by the formats, the manifest or the s3 connection once used
+LAZY_MODULES = ["pyarrow", "boto3", "botocore", "bson", "pandas", "numpy"]
+IMPORT = "from target_s3.target import Targets3"
+
+
+def import_times() -> dict:
+    """Self and cumulative microseconds per module of one cold import."""
+    script = f"import sys; {IMPORT}; print(' '.join(sys.modules))"
+    ret = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", script],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in ret.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:") :].split("|")
+        modules[name.strip()] = (int(self_us), int(cumulative_us))
+    return {"modules": modules, "loaded": ret.stdout.split()}
+
+
+def about_seconds() -> float:
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable, "-c", f"{IMPORT}; Targets3.cli()", "--about"],
+        capture_output=True,
+        check=True,
+    )
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms", type=float, default=None, help="Budget of the whole import."
+    )
+    parser.add_argument(
+        "--own-budget-ms",
+        type=float,
+        default=None,
+        help="Budget of the target_s3 modules themselves, without dependencies.",
+    )
+    args = parser.parse_args()
+
+    total, own, about = [], [], []
+    for _ in range(args.repeat):
+        ret = import_times()
+        modules = ret["modules"]
+        total.append(modules["target_s3.target"][1] / 1000)
+        own.append(
+            sum(s for name, (s, _) in modules.items() if name.startswith("target_s3"))
+            / 1000
+        )
+        about.append(about_seconds() * 1000)
+    loaded = sorted(
+        m for m in LAZY_MODULES if any(n.partition(".")[0] == m for n in ret["loaded"])
+    )
+    result = {
+        "import_ms": round(statistics.median(total), 1),
+        "own_import_ms": round(statistics.median(own), 1),
+        "about_ms": round(statistics.median(about), 1),
+        "eagerly_loaded": loaded,
+    }
+    print(json.dumps(result, indent=2))
+
+    failures = [f"{m} is imported at start" for m in loaded]
+    if args.budget_ms is not None and result["import_ms"] > args.budget_ms:
+        failures.append(f"import took {result['import_ms']}ms > {args.budget_ms}ms")
+    if args.own_budget_ms is not None and result["own_import_ms"] > args.own_budget_ms:
+        failures.append(
+            f"target_s3 modules took {result['own_import_ms']}ms "
+            f"> {args.own_budget_ms}ms"
+        )
+    if failures:
+        sys.exit("\n".join(failures))
+
+
+if __name__ == "__main__":
+    main()
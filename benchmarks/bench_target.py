@@ -0,0 +1,321 @@
+"""Benchmark Targets3 end to end against an in-process S3 stand-in (moto).
+
+Generates a synthetic Singer stream, runs the target on it once per format
+and option set, each in its own process, and prints one JSON document with
+records/s, MB/s, peak RSS and the time spent parsing, validating (the
+SDK's schema validation and timestamp parsing), serializing, compressing
+and uploading. Requires moto.
+
+    python benchmarks/bench_target.py --rows 50000 --columns 40 --nesting 2 \
+        --formats parquet,jsonl \
+        --options '{"zstd": {"format_jsonl": {"compression": "zstd"}}}' \
+        --output results.json
+
+Stage times are summed over threads, uploads run in the background, so
+they can add up to more than the wall time. Parquet compresses inside the
+parquet writer, which is counted as serialize.
+"""
+
+import argparse
+import collections
+import contextlib
+import functools
+import io
+import json
+import os
+import platform
+import random
+import resource
+import string
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+BUCKET = "benchmark"
+FORMATS = ["parquet", "jsonl", "json", "csv"]
+TYPES = ["integer", "number", "string", "boolean", "date-time"]
+
+
+def base_config(format_type: str) -> dict:
+    return {
+        "format": {"format_type": format_type},
+        "cloud_provider": {
+            "cloud_provider_type": "aws",
+            "aws": {
+                "aws_access_key_id": "benchmark",
+                "aws_secret_access_key": "benchmark",
+                "aws_region": "us-east-1",
+                "aws_bucket": BUCKET,
+            },
+        },
+        "prefix": "benchmark",
+        "append_date_to_filename_grain": "microsecond",
+    }
+
+
+def apply_options(config: dict, options: dict) -> dict:
+    """Sets top level options; `format_<type>` blocks go under `format`."""
+    for key, value in options.items():
+        if key.startswith("format_"):
+            config["format"][key] = value
+        else:
+            config[key] = value
+    return config
+
+
+def make_schema(columns: int, nesting: int, types: list) -> dict:
+    """A schema of `columns` fields cycling through `types`, plus `nesting`
+    levels of objects holding a few fields each."""
+    formats = {"date-time": {"type": ["string", "null"], "format": "date-time"}}
+    properties = {
+        f"col_{i}": formats.get(t, {"type": [t, "null"]})
+        for i, t in enumerate(types[i % len(types)] for i in range(columns))
+    }
+    inner = None
+    for level in range(nesting, 0, -1):
+        fields = {f"field_{i}": {"type": ["string", "null"]} for i in range(3)}
+        if inner:
+            fields["child"] = inner
+        inner = {"type": ["object", "null"], "properties": fields}
+    if inner:
+        properties["nested"] = inner
+    return {"type": "object", "properties": properties}
+
+
+def make_value(schema: dict, string_length: int, rng: random.Random):
+    types = schema["type"]
+    if "object" in types:
+        return {
+            k: make_value(v, string_length, rng)
+            for k, v in schema["properties"].items()
+        }
+    if schema.get("format") == "date-time":
+        start = datetime(2023, 1, 1, tzinfo=timezone.utc)
+        return (start + timedelta(seconds=rng.randrange(10**7))).isoformat()
+    if "integer" in types:
+        return rng.randrange(1 << 40)
+    if "number" in types:
+        return round(rng.random() * 1000, 4)
+    if "boolean" in types:
+        return rng.random() < 0.5
+    return "".join(rng.choices(string.ascii_letters, k=string_length))
+
+
+def make_stream(args) -> str:
+    """Returns the Singer messages of one synthetic stream."""
+    rng = random.Random(args.seed)
+    schema = make_schema(args.columns, args.nesting, args.types.split(","))
+    lines = [
+        json.dumps(
+            {
+                "type": "SCHEMA",
+                "stream": "benchmark",
+                "schema": schema,
+                "key_properties": [],
+            }
+        )
+    ]
+    for i in range(args.rows):
+        record = {
+            k: make_value(v, args.string_length, rng)
+            for k, v in schema["properties"].items()
+        }
+        lines.append(
+            json.dumps({"type": "RECORD", "stream": "benchmark", "record": record})
+        )
+    lines.append(json.dumps({"type": "STATE", "value": {"rows": args.rows}}))
+    return "\n".join(lines) + "\n"
+
+
+class Timers:
+    """Exclusive time per stage: time spent in a nested stage is only counted there."""
+
+    def __init__(self) -> None:
+        self.totals = collections.Counter()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def timed(self, name: str):
+        stack = self.local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self.lock:
+                self.totals[name] += elapsed - nested
+
+    def wrap(self, owner, attr: str, name: str) -> None:
+        fn = getattr(owner, attr)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.timed(name):
+                return fn(*args, **kwargs)
+
+        setattr(owner, attr, wrapper)
+
+
+class TimedCompressor:
+    """Times the writes to a compressor, not counting the upload they trigger."""
+
+    def __init__(self, timers: Timers, compressor) -> None:
+        self.timers = timers
+        self.compressor = compressor
+        self.file = None
+
+    def __enter__(self):
+        with self.timers.timed("compress"):
+            self.file = self.compressor.__enter__()
+        return self
+
+    def write(self, b) -> int:
+        with self.timers.timed("compress"):
+            return self.file.write(b)
+
+    def __exit__(self, *exc):
+        with self.timers.timed("compress"):
+            return self.compressor.__exit__(*exc)
+
+
+def instrument(timers: Timers) -> None:
+    from target_s3.formats import format_base
+    from target_s3.formats.format_base import FormatBase
+    from target_s3.formats.format_parquet import ParquetStreamWriter
+    from target_s3.sinks import s3Sink
+    from target_s3.target import Targets3
+    from target_s3.upload import MultipartWriter
+
+    timers.wrap(Targets3, "deserialize_json", "parse")
+    timers.wrap(s3Sink, "_validate_and_parse", "validate")
+    timers.wrap(FormatBase, "run", "serialize")
+    timers.wrap(ParquetStreamWriter, "close", "serialize")
+    for attr in ("write", "close", "_send_part"):
+        timers.wrap(MultipartWriter, attr, "upload")
+    open_compressor = format_base.open_compressor
+    format_base.open_compressor = lambda *args, **kwargs: TimedCompressor(
+        timers, open_compressor(*args, **kwargs)
+    )
+
+
+def run_case(case: dict, args) -> dict:
+    """Runs the target once, in this process, and returns its measurements."""
+    import boto3
+
+    try:
+        from moto import mock_aws
+    except ImportError:  # moto before 5.0
+        from moto import mock_s3 as mock_aws
+
+    from target_s3.target import Targets3
+
+    text = make_stream(args)
+    config = apply_options(base_config(case["format"]), case["options"])
+    timers = Timers()
+    instrument(timers)
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket=BUCKET)
+        target = Targets3(config=config)
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            target.listen(io.StringIO(text))
+        wall = time.perf_counter() - start
+        objects = client.list_objects_v2(Bucket=BUCKET).get("Contents", [])
+    input_bytes = len(text.encode("utf-8"))
+    output_bytes = sum(obj["Size"] for obj in objects)
+    # kilobytes on linux, bytes on macos
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss *= 1 if sys.platform == "darwin" else 1024
+    return {
+        **case,
+        "rows": args.rows,
+        "wall_seconds": round(wall, 4),
+        "records_per_second": round(args.rows / wall, 1),
+        "input_mb_per_second": round(input_bytes / wall / 1e6, 3),
+        "output_mb_per_second": round(output_bytes / wall / 1e6, 3),
+        "input_bytes": input_bytes,
+        "output_bytes": output_bytes,
+        "objects": len(objects),
+        "peak_rss_bytes": peak_rss,
+        "stage_seconds": {
+            stage: round(timers.totals[stage], 4)
+            for stage in ("parse", "validate", "serialize", "compress", "upload")
+        },
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--columns", type=int, default=20)
+    parser.add_argument(
+        "--nesting", type=int, default=1, help="levels of nested objects"
+    )
+    parser.add_argument("--string-length", type=int, default=16)
+    parser.add_argument("--types", default=",".join(TYPES), help="column types, cycled")
+    parser.add_argument("--formats", default=",".join(FORMATS))
+    parser.add_argument(
+        "--options",
+        default='{"default": {}}',
+        help="JSON object of named option sets, each applied to every format",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the results to this file")
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        # a single case, run by the parent in a fresh process
+        print(json.dumps(run_case(json.loads(args.case), args)))
+        return
+
+    results = []
+    for name, options in json.loads(args.options).items():
+        for format_type in args.formats.split(","):
+            case = {"format": format_type, "option_set": name, "options": options}
+            out = subprocess.run(
+                [sys.executable, __file__, *sys.argv[1:], "--case", json.dumps(case)],
+                check=True,
+                stdout=subprocess.PIPE,
+                text=True,
+            ).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+            results.append(result)
+            print(
+                f"{format_type:8} {name:12} "
+                f"{result['records_per_second']:>12,.0f} records/s "
+                f"{result['input_mb_per_second']:>8.2f} MB/s",
+                file=sys.stderr,
+            )
+    import pyarrow
+
+    ret = json.dumps(
+        {
+            "python": platform.python_version(),
+            "pyarrow": pyarrow.__version__,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parameters": {
+                k: v for k, v in vars(args).items() if k not in ("case", "output")
+            },
+            "results": results,
+        },
+        indent=2,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(ret)
+    else:
+        print(ret)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Merges the small objects written under a prefix into larger ones.
+
+    target-s3 compact --config config.json --prefix path/to/output/stream/
+
+Objects are grouped by folder, i.e. by partition, and by key extension.
+Parquet files are copied a row group at a time and JSONL objects a chunk
+at a time, so no partition is ever loaded into memory as a whole. The
+merged objects are written, then the manifests listing the sources are
+rewritten, and only then are the sources deleted.
+"""
+
+from __future__ import annotations
+
+import collections
+import json
+import logging
+import uuid
+from datetime import datetime, timezone
+
+import click
+from pyarrow import parquet
+
+from target_s3.connection import S3Connection
+from target_s3.formats.compression import open_compressor, open_decompressor
+from target_s3.formats.format_base import COMPRESSION
+from target_s3.formats.format_parquet import (
+    DEFAULT_MAX_FILE_BYTES,
+    PARQUET_COMPRESSION,
+    ParquetStreamWriter,
+    key_extension,
+    supports_compression_level,
+    writer_options,
+)
+from target_s3.manifest import ColumnStats, dump, object_entry
+from target_s3.upload import (
+    DEFAULT_MULTIPART_CONCURRENCY,
+    DEFAULT_MULTIPART_PART_SIZE,
+    DEFAULT_MULTIPART_THRESHOLD,
+    MultipartWriter,
+)
+
+LOGGER = logging.getLogger("target-s3")
+# size of the chunks JSONL objects are copied in
+COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def split_key(key: str) -> tuple:
+    """Splits a key into its folder and extension, e.g. `jsonl.gz`."""
+    folder, _, file_name = key.rpartition("/")
+    return folder, file_name.partition(".")[2]
+
+
+def jsonl_codec(extension: str):
+    """The compression codec of a JSONL key extension, False if not JSONL."""
+    if extension == "jsonl":
+        return None
+    codecs = {v: k for k, v in COMPRESSION.items() if v}
+    name, _, compression = extension.partition(".")
+    if name == "jsonl" and compression in codecs:
+        return codecs[compression]
+    return False
+
+
+def find_small_objects(client, bucket: str, prefix: str, max_bytes: int) -> dict:
+    """Lists the objects below `max_bytes` that can be compacted.
+
+    :return: lists of `(key, size)`, keyed by `(folder, extension)`; groups
+        of a single object are left out
+    """
+    groups = collections.defaultdict(list)
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            folder, extension = split_key(obj["Key"])
+            if obj["Size"] >= max_bytes:
+                continue
+            if extension.endswith("parquet") or jsonl_codec(extension) is not False:
+                groups[(folder, extension)].append((obj["Key"], obj["Size"]))
+    return {group: objects for group, objects in groups.items() if len(objects) > 1}
+
+
+class Compactor:
+    """Merges groups of small objects into files of about `max_bytes`."""
+
+    def __init__(self, config: dict, max_bytes: int = DEFAULT_MAX_FILE_BYTES) -> None:
+        self.config = config
+        self.max_bytes = max_bytes
+        self.connection = S3Connection(config)
+        self.client = self.connection.client
+        self.bucket = self.connection.aws_config.get("aws_bucket", None)
+        assert self.bucket, "Compactor.__init__: Expecting aws_bucket in configuration."
+        format_parquet = config.get("format", {}).get("format_parquet", None) or {}
+        self.parquet_compression = format_parquet.get("compression", "gzip")
+        assert (
+            self.parquet_compression in PARQUET_COMPRESSION
+        ), f"Compactor.__init__: Unknown compression {self.parquet_compression}."
+        self.parquet_compression_level = format_parquet.get("compression_level", None)
+        assert self.parquet_compression_level is None or supports_compression_level(
+            self.parquet_compression
+        ), (
+            f"Compactor.__init__: Compression {self.parquet_compression} doesn't "
+            "take a compression_level."
+        )
+        self.parquet_row_group_size = format_parquet.get("row_group_size", None)
+        self.parquet_options = writer_options(format_parquet)
+        # manifest keys by `_manifests/` folder, see manifest_keys
+        self.manifests = {}
+
+    def open_output(self, path: str) -> MultipartWriter:
+        """Opens a binary file object writing to `bucket/key`."""
+        bucket, _, key = path.partition("/")
+        return MultipartWriter(
+            self.client,
+            bucket,
+            key,
+            part_size=self.config.get(
+                "multipart_part_size", DEFAULT_MULTIPART_PART_SIZE
+            ),
+            threshold=self.config.get(
+                "multipart_threshold", DEFAULT_MULTIPART_THRESHOLD
+            ),
+            concurrency=self.config.get(
+                "multipart_concurrency", DEFAULT_MULTIPART_CONCURRENCY
+            ),
+        )
+
+    def output_key(self, folder: str, extension: str) -> str:
+        return f"{self.bucket}/{folder}/compacted-{uuid.uuid4().hex}.{extension}"
+
+    def compact(self, prefix: str, dry_run: bool = False) -> list:
+        """Compacts every group of small objects under `prefix`.
+
+        :return: `{"sources": [...], "outputs": [...]}` for every group
+        """
+        ret = []
+        groups = find_small_objects(self.client, self.bucket, prefix, self.max_bytes)
+        for (folder, extension), objects in sorted(groups.items()):
+            sources = [key for key, _ in objects]
+            size = sum(size for _, size in objects)
+            LOGGER.info(
+                f"compacting {len(sources)} objects ({size} bytes) "
+                f"in {folder}/*.{extension}"
+            )
+            outputs = []
+            if not dry_run:
+                if extension.endswith("parquet"):
+                    merged = self.compact_parquet(folder, extension, sources)
+                else:
+                    merged = self.compact_jsonl(folder, extension, sources)
+                self.update_manifests(folder, merged)
+                self.delete(sources)
+                outputs = list(merged)
+            ret.append({"sources": sources, "outputs": outputs})
+        return ret
+
+    def compact_parquet(self, folder: str, extension: str, sources: list) -> dict:
+        """Copies the row groups of every source into files of about max_bytes.
+
+        :return: `{"sources", "bytes", "stats"}` of every output, by key
+        """
+        merged = {}
+        merging = set()
+
+        def on_close(key, metadata, size):
+            stats = ColumnStats()
+            stats.add_parquet(metadata)
+            merged[key.partition("/")[2]] = {
+                "sources": sorted(merging),
+                "bytes": size,
+                "stats": stats,
+            }
+            merging.clear()
+
+        writer = ParquetStreamWriter(
+            LOGGER,
+            compression=self.parquet_compression,
+            compression_level=self.parquet_compression_level,
+            max_file_bytes=self.max_bytes,
+            row_group_size=self.parquet_row_group_size,
+            options=self.parquet_options,
+            on_close=on_close,
+        )
+        # the codec written, which may not be the one of the sources
+        key = self.output_key(folder, key_extension(self.parquet_compression))
+        try:
+            for source in sources:
+                with self.connection.file_system.open_input_file(
+                    f"{self.bucket}/{source}"
+                ) as f:
+                    parquet_file = parquet.ParquetFile(f)
+                    for i in range(parquet_file.num_row_groups):
+                        merging.add(source)
+                        writer.write(
+                            key, parquet_file.read_row_group(i), self.open_output
+                        )
+            writer.close()
+        except BaseException:
+            # sources are kept, so drop what was merged so far
+            if writer.stream is not None:
+                writer.stream.terminate()
+            self.delete([k.partition("/")[2] for k in writer.keys])
+            raise
+        return dict(sorted(merged.items()))
+
+    def compact_jsonl(self, folder: str, extension: str, sources: list) -> dict:
+        """Concatenates the lines of every source into objects of about max_bytes.
+
+        :return: `{"sources", "bytes", "rows", "stats"}` of every output, by
+            key; the column stats are left to update_manifests
+        """
+        codec = jsonl_codec(extension)
+        merged = {}
+        raw = out = None
+        try:
+            for source in sources:
+                if raw is None:
+                    key = self.output_key(folder, extension)
+                    raw = self.open_output(key)
+                    out = open_compressor(raw, codec) if codec else raw
+                    output = merged[key.partition("/")[2]] = {
+                        "sources": [],
+                        "bytes": 0,
+                        "rows": 0,
+                        "stats": None,
+                    }
+                    last = b"\n"
+                elif last != b"\n":
+                    # objects written by the target don't end with a newline
+                    out.write(b"\n")
+                output["sources"].append(source)
+                body = self.client.get_object(Bucket=self.bucket, Key=source)["Body"]
+                with open_decompressor(body, codec) as f:
+                    while True:
+                        chunk = f.read(COPY_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        out.write(chunk)
+                        output["rows"] += chunk.count(b"\n")
+                        last = chunk[-1:]
+                if last != b"\n":
+                    output["rows"] += 1
+                if raw.tell() >= self.max_bytes:
+                    out.close()
+                    raw.close()
+                    output["bytes"] = raw.tell()
+                    raw = out = None
+            if raw is not None:
+                out.close()
+                raw.close()
+                output["bytes"] = raw.tell()
+        except BaseException:
+            # sources are kept, so drop what was merged so far
+            if raw is not None:
+                raw.terminate()
+            self.delete(list(merged))
+            raise
+        return merged
+
+    def manifest_keys(self, folder: str) -> list:
+        """The manifests in a `_manifests` folder of `folder` or of a parent."""
+        ret = []
+        parts = folder.split("/")
+        for i in range(len(parts), 0, -1):
+            prefix = "/".join(parts[:i]) + "/_manifests/"
+            if prefix not in self.manifests:
+                paginator = self.client.get_paginator("list_objects_v2")
+                self.manifests[prefix] = [
+                    obj["Key"]
+                    for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix)
+                    for obj in page.get("Contents", [])
+                    if obj["Key"].endswith(".json")
+                ]
+            ret += self.manifests[prefix]
+        return ret
+
+    def update_manifests(self, folder: str, merged: dict) -> None:
+        """Replaces the merged sources with their outputs in the manifests.
+
+        Every output is listed once, in the latest manifest listing one of
+        its sources. The column stats of merged JSONL objects are combined
+        from the entries of their sources, if every source has one.
+        """
+        sources = {s for output in merged.values() for s in output["sources"]}
+        documents = {}
+        for key in self.manifest_keys(folder):
+            body = self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+            document = json.loads(body.read())
+            if any(entry["key"] in sources for entry in document["objects"]):
+                documents[key] = document
+        if not documents:
+            return
+        entries = {}
+        for key, document in documents.items():
+            for entry in document["objects"]:
+                if entry["key"] in sources:
+                    entries[entry["key"]] = (key, entry)
+            document["objects"] = [
+                entry for entry in document["objects"] if entry["key"] not in sources
+            ]
+        for output_key, output in merged.items():
+            listed = [entries[s] for s in output["sources"] if s in entries]
+            if not listed:
+                continue
+            manifest_key = max(
+                (key for key, _ in listed),
+                key=lambda key: documents[key]["started_at"] or "",
+            )
+            stats = output["stats"]
+            if stats is None:
+                stats = ColumnStats()
+                if len(listed) == len(output["sources"]):
+                    stats.add_entries([entry for _, entry in listed])
+                stats.rows = output["rows"]
+            documents[manifest_key]["objects"].append(
+                object_entry(
+                    output_key, output["bytes"], stats, listed[0][1]["partition"]
+                )
+            )
+        for key, document in documents.items():
+            LOGGER.info(f"rewriting manifest {key}")
+            document["updated_at"] = datetime.now(timezone.utc).isoformat()
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=key,
+                Body=dump(document),
+                ContentType="application/json",
+            )
+
+    def delete(self, keys: list) -> None:
+        """Deletes the merged source objects."""
+        # delete_objects accepts at most 1000 keys at once
+        for i in range(0, len(keys), 1000):
+            response = self.client.delete_objects(
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": k} for k in keys[i : i + 1000]]},
+            )
+            for error in response.get("Errors", []):
+                LOGGER.warning(f"failed to delete {error['Key']}: {error['Message']}")
+
+
+@click.command()
+@click.option(
+    "--config",
+    "config_files",
+    multiple=True,
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="The target's configuration file, may be given more than once.",
+)
+@click.option(
+    "--prefix",
+    default=None,
+    help=(
+        "Key prefix to compact, e.g. a stream or partition folder. Defaults to the "
+        "configured prefix."
+    ),
+)
+@click.option(
+    "--max-file-bytes",
+    type=int,
+    default=DEFAULT_MAX_FILE_BYTES,
+    show_default=True,
+    help=(
+        "Objects of this size or larger are left alone, merged objects are rolled at "
+        "this size."
+    ),
+)
+@click.option(
+    "--dry-run", is_flag=True, help="Only list the objects that would be merged."
+)
+def cli(config_files, prefix, max_file_bytes, dry_run) -> None:
+    """Merge the small Parquet and JSONL objects under a prefix."""
+    logging.basicConfig(level=logging.INFO)
+    config = {}
+    for path in config_files:
+        with open(path) as f:
+            config.update(json.load(f))
+    if prefix is None:
+        prefix = config.get("prefix", None) or ""
+    ret = Compactor(config, max_file_bytes).compact(prefix, dry_run=dry_run)
+    click.echo(json.dumps(ret, indent=2))
@@ -0,0 +1,110 @@
+"""s3 connection cache, shared by every sink and format of a target."""
+
+from __future__ import annotations
+
+import logging
+import threading
+
+from target_s3.upload import DEFAULT_MULTIPART_CONCURRENCY
+
+LOGGER = logging.getLogger("target-s3")
+DEFAULT_UPLOAD_CONCURRENCY = 10
+
+
+class S3Connection:
+    """Holds one boto3 session/client and one pyarrow filesystem per target.
+
+    The formats write through the client; the filesystem is only used by
+    `target-s3 compact` to read parquet files back.
+
+    Building these objects resolves credentials, sets up endpoints and opens
+    new TLS connections, so they are created once and reused for every batch.
+    The boto3 client refreshes expiring credentials on its own; the pyarrow
+    filesystem takes static credentials, so it is rebuilt whenever the
+    session hands out a different set.
+    """
+
+    def __init__(self, config: dict) -> None:
+        self.config = config
+        cloud_provider = config.get("cloud_provider", None)
+        assert (
+            cloud_provider
+        ), "S3Connection.__init__: Expecting cloud provider in configuration"
+        self.aws_config = cloud_provider.get("aws", None)
+        assert self.aws_config, "S3Connection.__init__: Expecting aws in configuration"
+
+        # every upload worker may send several parts of an object at once
+        self.max_pool_connections = int(
+            config.get("upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY)
+        ) * int(config.get("multipart_concurrency", DEFAULT_MULTIPART_CONCURRENCY))
+        self._lock = threading.Lock()
+        self._session = None
+        self._client = None
+        self._file_system = None
+        self._file_system_credentials = None
+
+    @property
+    def session(self):
+        """The boto3 session, created on first use."""
+        if self._session is None:
+            # boto3 takes a while to import and isn't needed to e.g. print --about
+            from boto3 import Session
+
+            with self._lock:
+                if self._session is None:
+                    self._session = Session(
+                        aws_access_key_id=self.aws_config.get(
+                            "aws_access_key_id", None
+                        ),
+                        aws_secret_access_key=self.aws_config.get(
+                            "aws_secret_access_key", None
+                        ),
+                        aws_session_token=self.aws_config.get(
+                            "aws_session_token", None
+                        ),
+                        region_name=self.aws_config.get("aws_region"),
+                        profile_name=self.aws_config.get("aws_profile_name", None),
+                    )
+        return self._session
+
+    @property
+    def client(self):
+        """The s3 client, created on first use with a pool sized for uploads."""
+        if self._client is None:
+            from botocore.config import Config
+
+            session = self.session
+            with self._lock:
+                if self._client is None:
+                    self._client = session.client(
+                        "s3",
+                        endpoint_url=self.aws_config.get("aws_endpoint_override", None),
+                        config=Config(max_pool_connections=self.max_pool_connections),
+                    )
+        return self._client
+
+    @property
+    def file_system(self):
+        """The pyarrow S3FileSystem, rebuilt only when credentials change."""
+        # frozen credentials trigger a refresh when a session token is about to expire
+        credentials = self.session.get_credentials()
+        frozen = credentials.get_frozen_credentials() if credentials else None
+        with self._lock:
+            if self._file_system is None or frozen != self._file_system_credentials:
+                from pyarrow import fs
+
+                if self._file_system is not None:
+                    LOGGER.info(
+                        "s3 credentials changed, rebuilding parquet file system."
+                    )
+                self._file_system = fs.S3FileSystem(
+                    access_key=frozen.access_key if frozen else None,
+                    secret_key=frozen.secret_key if frozen else None,
+                    session_token=frozen.token if frozen else None,
+                    region=self.session.region_name,
+                    endpoint_override=self.aws_config.get(
+                        "aws_endpoint_override", None
+                    ),
+                )
+                self._file_system_credentials = frozen
+            return self._file_system
@@ -0,0 +1,52 @@
+"""Compression codecs of the objects the formats write."""
+
+import bz2
+import gzip
+from contextlib import nullcontext
+
+# codecs open_compressor passes a compression level to
+LEVELED_CODECS = ["gzip", "bz2", "zstd"]
+
+
+def zstandard_module():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError(
+            "zstd compression requires the zstandard package, "
+            "install target-s3[fast]."
+        ) from e
+    return zstandard
+
+
+def open_compressor(file_obj, codec: str, level: int = None):
+    """Wraps a writable binary file object in a compression codec."""
+    if codec == "gzip":
+        return gzip.GzipFile(
+            fileobj=file_obj,
+            mode="wb",
+            # 9 costs several times the CPU of 6 for a few percent smaller objects
+            compresslevel=6 if level is None else level,
+        )
+    if codec == "bz2":
+        return bz2.BZ2File(file_obj, "wb", compresslevel=9 if level is None else level)
+    if codec == "zstd":
+        return (
+            zstandard_module()
+            .ZstdCompressor(level=3 if level is None else level)
+            .stream_writer(file_obj, closefd=False)
+        )
+    return nullcontext(file_obj)
+
+
+def open_decompressor(file_obj, codec: str):
+    """Wraps a readable binary file object, decompressing what is read."""
+    if codec == "gzip":
+        return gzip.GzipFile(fileobj=file_obj, mode="rb")
+    if codec == "bz2":
+        return bz2.BZ2File(file_obj, "rb")
+    if codec == "zstd":
+        return (
+            zstandard_module().ZstdDecompressor().stream_reader(file_obj, closefd=False)
+        )
+    return nullcontext(file_obj)
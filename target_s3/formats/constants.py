@@ -0,0 +1,29 @@
+"""Option values of the formats, declared apart from the formats themselves.
+
+The target's config schema needs these on every start, the modules of the
+formats import pyarrow, so they are only imported once a format is used.
+"""
+
+# how objects and arrays are written to a csv cell
+NESTED_VALUES = ["json", "null"]
+# partition grain: (strftime format, length of the matching ISO 8601 prefix)
+PARTITION_GRAIN = {
+    "year": ("%Y", 4),
+    "month": ("%Y-%m", 7),
+    "day": ("%Y-%m-%d", 10),
+    "hour": ("%Y-%m-%dT%H", 13),
+}
+# parquet compression codec: object key extension
+PARQUET_COMPRESSION = {
+    "none": None,
+    "gzip": "gz",
+    "zstd": "zstd",
+    "snappy": "snappy",
+    "lz4": "lz4",
+    "brotli": "br",
+}
+DEFAULT_MAX_FILE_BYTES = 128 * 1024 * 1024
+# parquet files a stream keeps open at once, one per partition
+DEFAULT_MAX_OPEN_FILES = 16
+# parquet format versions the writer accepts
+PARQUET_VERSIONS = ["1.0", "2.4", "2.6"]
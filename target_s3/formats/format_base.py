@@ -1,14 +1,23 @@
-import re
-import inflection
-import json
 import collections
+import json
 import logging
-from datetime import datetime
+import re
+import time
 from abc import ABCMeta, abstractmethod
+from datetime import datetime, timezone
 
-from boto3 import Session
-from smart_open import open
+import inflection
 
+from target_s3.connection import S3Connection
+from target_s3.formats.compression import LEVELED_CODECS, open_compressor
+from target_s3.metrics import BatchMetrics
+from target_s3.spool import SpooledRecords
+from target_s3.upload import (
+    DEFAULT_MULTIPART_CONCURRENCY,
+    DEFAULT_MULTIPART_PART_SIZE,
+    DEFAULT_MULTIPART_THRESHOLD,
+    MultipartWriter,
+)
 
 LOGGER = logging.getLogger("target-s3")
 DATE_GRAIN = {
@@ -20,7 +29,15 @@ DATE_GRAIN = {
     "second": 2,
     "microsecond": 1,
 }
-COMPRESSION = {}
+# number of records serialized at a time when streaming an object
+WRITE_CHUNK_SIZE = 1000
+# compression codec: object key extension
+COMPRESSION = {
+    "none": None,
+    "gzip": "gz",
+    "zstd": "zst",
+    "bz2": "bz2",
+}
 
 
 def format_type_factory(object_type_class, *pargs, **kargs):
@@ -32,6 +49,8 @@ class FormatBase(metaclass=ABCMeta):
 
     """This is the object type base class"""
 
+    compression_types = COMPRESSION
+
     def __init__(self, config: dict, context: dict, extension: str) -> None:
         # TODO: perhaps we should do some scrubbing here?
         self.config = config
@@ -46,26 +65,40 @@ class FormatBase(metaclass=ABCMeta):
 
         self.context = context
         self.extension = extension
-        self.compression = "gz"  # TODO: need a list of compatible compression types
+        self.metrics = BatchMetrics()
+        # each format is configured in its own block, e.g. format_json
+        format_config = self.format.get(f"format_{extension}", None) or {}
+        self.compression_codec = format_config.get("compression", "gzip")
+        assert self.compression_codec in self.compression_types, (
+            f"FormatBase.__init__: Unknown compression {self.compression_codec} "
+            f"for {extension}."
+        )
+        self.compression_level = format_config.get("compression_level", None)
+        assert self.compression_level is None or self.supports_compression_level(), (
+            f"FormatBase.__init__: Compression {self.compression_codec} doesn't "
+            "take a compression_level."
+        )
+        self.compression = self.compression_types[self.compression_codec]
 
         self.stream_name_path_override = config.get("stream_name_path_override", None)
+        self.partition_by = config.get("partition_by", None) or []
+        # partition path of the object being written, e.g. `year=2023`
+        self.partition = ""
+        # lists every written object, if enabled, see Targets3.manifest
+        self.manifest = context.get("manifest", None)
+        self.object_stats = None
+        # columns added to every record, the same for the whole batch
+        self.metadata = self.batch_metadata()
 
         if self.cloud_provider.get("cloud_provider_type", None) == "aws":
             aws_config = self.cloud_provider.get("aws", None)
             assert aws_config, "FormatBase.__init__: Expecting aws in configuration"
 
             self.bucket = aws_config.get("aws_bucket", None)  # required
-            self.session = Session(
-                aws_access_key_id=aws_config.get("aws_access_key_id", None),
-                aws_secret_access_key=aws_config.get("aws_secret_access_key", None),
-                aws_session_token=aws_config.get("aws_session_token", None),
-                region_name=aws_config.get("aws_region"),
-                profile_name=aws_config.get("aws_profile_name", None),
-            )
-            self.client = self.session.client(
-                "s3",
-                endpoint_url=aws_config.get("aws_endpoint_override", None),
-            )
+            # reuse the target's connection, only build one when running standalone
+            self.connection = context.get("connection", None) or S3Connection(config)
+            self.session = self.connection.session
+            self.client = self.connection.client
 
         steam_name: str = self.context["stream_name"]
         self.prefix = config.get("prefix", None)
@@ -80,29 +113,186 @@ class FormatBase(metaclass=ABCMeta):
     @abstractmethod
     def _write(self, contents: str = None) -> None:
         """Execute the write to S3. (default)"""
+        self._write_chunks([contents.encode("utf-8")])
+
+    def _write_chunks(self, chunks) -> None:
+        """Stream chunks of bytes to S3 as they are produced. (default)"""
+        metrics = self.metrics
+        start, serialize = time.perf_counter(), metrics.seconds["serialize"]
+        # filled in by chunk_records as the records are serialized
+        self.object_stats = None
+        if self.manifest:
+            # imported on use, like the partitioning below it loads pyarrow
+            from target_s3.manifest import ColumnStats
+
+            self.object_stats = ColumnStats()
+        with self.open_output(self.fully_qualified_key) as raw:
+            with self.compressor(raw) as f:
+                for chunk in metrics.timed("serialize", chunks):
+                    metrics.serialized_bytes += len(chunk)
+                    f.write(chunk)
+        # what is left after producing the chunks and uploading is compression
+        elapsed = time.perf_counter() - start
+        metrics.seconds["compress"] += (
+            elapsed - (metrics.seconds["serialize"] - serialize) - raw.busy_seconds
+        )
+        metrics.seconds["upload"] += raw.busy_seconds
+        metrics.output_bytes += raw.tell()
+        if self.manifest:
+            if self.object_stats.rows:
+                for name, value in self.metadata.items():
+                    self.object_stats.update(name, value, value)
+            self.manifest.add(
+                self.fully_qualified_key, raw.tell(), self.object_stats, self.partition
+            )
+
+    def open_output(self, path: str) -> MultipartWriter:
+        """Opens a binary file object writing to `bucket/key` in parallel parts."""
         # TODO: create dynamic cloud
-        # TODO: is there a better way to handle write contents ?
-        with open(
-            f"s3://{self.fully_qualified_key}",
-            "w",
-            transport_params={"client": self.client},
-        ) as f:
-            f.write(contents)
+        bucket, _, key = path.partition("/")
+        return MultipartWriter(
+            self.client,
+            bucket,
+            key,
+            part_size=self.config.get(
+                "multipart_part_size", DEFAULT_MULTIPART_PART_SIZE
+            ),
+            threshold=self.config.get(
+                "multipart_threshold", DEFAULT_MULTIPART_THRESHOLD
+            ),
+            concurrency=self.config.get(
+                "multipart_concurrency", DEFAULT_MULTIPART_CONCURRENCY
+            ),
+        )
+
+    def chunk_records(self, size: int = None):
+        """Yields the records in lists of `size`, WRITE_CHUNK_SIZE by default."""
+        size = size or WRITE_CHUNK_SIZE
+        if isinstance(self.records, SpooledRecords):
+            # read back from disk a chunk at a time
+            chunks = self.records.chunks(size)
+        else:
+            chunks = (
+                self.records[i : i + size] for i in range(0, len(self.records), size)
+            )
+        for chunk in chunks:
+            if self.object_stats is not None:
+                self.object_stats.add_records(chunk)
+            yield chunk
+
+    def supports_compression_level(self) -> bool:
+        """Whether the configured codec takes a compression level. (default)"""
+        return self.compression_codec in LEVELED_CODECS
+
+    def compressor(self, file_obj):
+        """Wraps a binary file object in the configured compression codec."""
+        return open_compressor(file_obj, self.compression_codec, self.compression_level)
 
     @abstractmethod
     def run(self, records) -> None:
         """Execute the steps for preparing/writing records to S3. (default)"""
         self.records = records
         # prepare records for writing
-        self._prepare_records()
+        with self.metrics.timer("prepare"):
+            self._prepare_records()
         # write records to S3
-        self._write()
+        if self.partition_by:
+            self._write_partitions()
+        else:
+            self._write()
+
+    def _write_partitions(self) -> None:
+        """Write one object per partition of the records. (default)"""
+        from target_s3.formats.partition import group_rows, partition_paths
+
+        records, key = self.records, self.fully_qualified_key
+        if isinstance(records, SpooledRecords):
+            # rows are picked by index, so the batch is read back into memory
+            records = list(records)
+        columns = {
+            p["field"]: [self.metadata[p["field"]]] * len(records)
+            if p["field"] in self.metadata
+            else [record.get(p["field"]) for record in records]
+            for p in self.partition_by
+        }
+        with self.metrics.timer("prepare"):
+            groups = group_rows(partition_paths(columns, self.partition_by))
+        for path, indices in groups:
+            self.records = [records[i] for i in indices.to_pylist()]
+            self.fully_qualified_key = self.partition_key(key, path)
+            self.partition = path
+            self._write()
+        self.records, self.fully_qualified_key = records, key
+        self.partition = ""
+
+    def partition_key(self, key: str, path: str) -> str:
+        """Inserts the partition path in front of the key's file name."""
+        folder, _, file_name = key.rpartition("/")
+        return f"{folder}/{path}/{file_name}"
+
+    @classmethod
+    def finalize(cls, stream_cache: dict) -> BatchMetrics:
+        """Close anything kept open across batches in the stream cache. (default)
+
+        :return: what closing took, if anything
+        """
+        return None
 
     @abstractmethod
     def _prepare_records(self) -> None:
         """Execute record prep. (default)"""
+        # batch metadata is added when serializing, see with_metadata
+        pass
+
+    def batch_metadata(self) -> dict:
+        """The metadata columns enabled in the config, evaluated once per batch.
+
+        Columns the stream schema already has, e.g. the `_sdc_*` properties
+        the SDK adds with `add_record_metadata`, are left to the records.
+        """
+        ret = {}
         if self.config.get("include_process_date", None):
-            self.records = self.append_process_date(self.records)
+            ret["_PROCESS_DATE"] = datetime.utcnow()
+        if self.config.get("include_batch_id", None):
+            ret["_BATCH_ID"] = self.context.get("batch_id", None)
+        if self.config.get("include_stream_name", None):
+            ret["_STREAM_NAME"] = self.context["stream_name"]
+        if self.config.get("include_sdc_batch_metadata", None):
+            batch_start = self.context.get("batch_start_time", None) or datetime.now(
+                tz=timezone.utc
+            )
+            # the values the SDK's _add_sdc_metadata_to_record would set
+            ret["_sdc_batched_at"] = batch_start.isoformat()
+            ret["_sdc_sync_started_at"] = self.context.get("sync_started_at", None)
+        properties = self.context.get("stream_schema", {}).get("properties", {})
+        return {k: v for k, v in ret.items() if k not in properties}
+
+    def with_metadata(self, encode):
+        """Wraps a JSON record encoder to append the metadata columns to every object.
+
+        The columns are encoded once, every encoded record gets them spliced
+        in before its closing brace; the records themselves are left as is.
+        A record that has a metadata column itself, although the schema
+        doesn't declare it, keeps its own value, so no key is written twice.
+        """
+        if not self.metadata:
+            return encode
+        fields = encode(self.metadata)[1:-1]
+        # the encoder's own separator, e.g. `, ` for simplejson
+        probe = encode({"a": 0, "b": 0})
+        separator = probe[probe.index(b"0") + 1 : probe.index(b'"b"')]
+        tail = separator + fields + b"}"
+        names = tuple(self.metadata)
+
+        def encode_with_metadata(record) -> bytes:
+            if any(name in record for name in names):
+                return encode({**self.metadata, **record})
+            line = encode(record)
+            if line == b"{}":
+                return b"{" + fields + b"}"
+            return line[:-1] + tail
+
+        return encode_with_metadata
 
     def create_key(self) -> str:
         batch_start = self.context["batch_start_time"]
@@ -124,8 +314,18 @@ class FormatBase(metaclass=ABCMeta):
         if self.config["append_date_to_filename"]:
             grain = DATE_GRAIN[self.config["append_date_to_filename_grain"].lower()]
             file_name += f"{self.create_file_structure(batch_start, grain)}"
+        batch_id = self.context.get("batch_id", None)
+        if batch_id and self.config.get("append_batch_id_to_filename", True):
+            # batches within one date grain would otherwise overwrite each other
+            file_name += f"-{batch_id}" if file_name else batch_id
 
-        return f"{folder_path}{file_name}.{self.extension}.{self.compression}"
+        return f"{folder_path}{file_name}.{self.key_extension()}"
+
+    def key_extension(self) -> str:
+        """The extension of object keys, e.g. `json.gz`. (default)"""
+        if self.compression:
+            return f"{self.extension}.{self.compression}"
+        return self.extension
 
     def create_folder_structure(
         self, batch_start: datetime, grain: int, partition_name_enabled: bool
@@ -180,12 +380,3 @@ class FormatBase(metaclass=ABCMeta):
             f"{batch_start.microsecond}" if grain <= DATE_GRAIN["microsecond"] else ""
         )
         return ret
-
-    def append_process_date(self, records) -> dict:
-        """A function that appends the current UTC to every record"""
-
-        def process_date(record):
-            record["_PROCESS_DATE"] = datetime.utcnow()
-            return record
-
-        return list(map(lambda x: process_date(x), records))
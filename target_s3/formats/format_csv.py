@@ -1,7 +1,102 @@
+import io
+
+import pyarrow
+from pyarrow import csv
+
+from target_s3.formats.constants import NESTED_VALUES
 from target_s3.formats.format_base import FormatBase
+from target_s3.formats.json_encoder import get_encoder
 
 
 class FormatCsv(FormatBase):
-    def __init__(self) -> None:
-        super().__init__()
-        raise NotImplementedError
+    def __init__(self, config, context) -> None:
+        super().__init__(config, context, "csv")
+        format_csv = self.format.get("format_csv", None) or {}
+        self.delimiter = format_csv.get("delimiter", ",")
+        assert (
+            len(self.delimiter) == 1
+        ), "FormatCsv.__init__: Expecting a single character delimiter."
+        self.include_header = format_csv.get("include_header", True)
+        self.nested_values = format_csv.get("nested_values", "json")
+        assert (
+            self.nested_values in NESTED_VALUES
+        ), f"FormatCsv.__init__: Unknown nested_values {self.nested_values}."
+        self.stream_schema = context.get("stream_schema", {})
+        self.encode = get_encoder()
+
+    def _prepare_records(self):
+        # use default behavior, no additional prep needed
+        return super()._prepare_records()
+
+    def _write(self) -> None:
+        return super()._write_chunks(self.serialize())
+
+    def columns(self) -> list:
+        """The schema's properties in order, other record keys, then the metadata."""
+        columns = dict.fromkeys(self.stream_schema.get("properties", {}))
+        for record in self.records:
+            columns.update(dict.fromkeys(record))
+        columns.update(dict.fromkeys(self.metadata))
+        return list(columns)
+
+    def serialize(self):
+        """Yields the records as csv, a chunk of records at a time.
+
+        Every chunk is converted to Arrow columns and written by the pyarrow
+        csv writer, so the column order is the same for every chunk.
+        """
+        columns = self.columns()
+        for i, chunk in enumerate(self.chunk_records()):
+            table = pyarrow.table(
+                [
+                    # metadata columns hold one value, repeated by arrow
+                    pyarrow.repeat(self.metadata[c], len(chunk))
+                    if c in self.metadata
+                    else self.convert_column([r.get(c) for r in chunk])
+                    for c in columns
+                ],
+                names=columns,
+            )
+            buffer = io.BytesIO()
+            csv.write_csv(
+                table,
+                buffer,
+                csv.WriteOptions(
+                    include_header=self.include_header and i == 0,
+                    delimiter=self.delimiter,
+                ),
+            )
+            yield buffer.getvalue()
+
+    def convert_column(self, values: list) -> pyarrow.Array:
+        """Converts the values of one column, writing mixed types as strings."""
+        if any(isinstance(v, (dict, list)) for v in values):
+            values = [self.nested_value(v) for v in values]
+        try:
+            return pyarrow.array(values)
+        except (
+            pyarrow.ArrowInvalid,
+            pyarrow.ArrowTypeError,
+            OverflowError,
+            UnicodeError,
+        ):
+            # OverflowError: integers beyond 64 bits
+            return pyarrow.array(
+                [None if v is None else self.to_string(v) for v in values],
+                pyarrow.string(),
+            )
+
+    def nested_value(self, value):
+        if not isinstance(value, (dict, list)):
+            return value
+        if self.nested_values == "null":
+            return None
+        return self.encode(value).decode("utf-8")
+
+    def to_string(self, value) -> str:
+        # joins surrogate pairs and replaces lone surrogates, utf-8 can't hold them
+        return str(value).encode("utf-16", "surrogatepass").decode("utf-16", "replace")
+
+    def run(self) -> None:
+        # use default behavior, no additional run steps needed
+        return super().run(self.context["records"])
@@ -1,25 +1,14 @@
-from datetime import datetime
-
-from bson import ObjectId
-from simplejson import JSONEncoder, dumps
-
 from target_s3.formats.format_base import FormatBase
-
-
-class JsonSerialize(JSONEncoder):
-    def default(self, obj: any) -> any:
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        else:
-            raise TypeError(f"Type {type(obj)} not serializable")
+from target_s3.formats.json_encoder import get_encoder
 
 
 class FormatJson(FormatBase):
     def __init__(self, config, context) -> None:
         super().__init__(config, context, "json")
-        pass
+        format_json = self.format.get("format_json", None) or {}
+        encode = get_encoder(format_json.get("encoder", "auto"))
+        # the batch metadata columns are spliced into every encoded record
+        self.encode = self.with_metadata(encode)
 
     def _prepare_records(self):
         # use default behavior, no additional prep needed
@@ -27,7 +16,15 @@ class FormatJson(FormatBase):
         return super()._prepare_records()
 
     def _write(self) -> None:
-        return super()._write(dumps(self.records, cls=JsonSerialize, use_decimal=True))
+        return super()._write_chunks(self.serialize())
+
+    def serialize(self):
+        """Yields the records as one JSON array, a chunk of records at a time."""
+        yield b"["
+        for i, chunk in enumerate(self.chunk_records()):
+            text = b", ".join(map(self.encode, chunk))
+            yield text if i == 0 else b", " + text
+        yield b"]"
 
     def run(self) -> None:
         # use default behavior, no additional run steps needed
@@ -1,32 +1,27 @@
-from datetime import datetime
-
-from bson import ObjectId
-from simplejson import JSONEncoder, dumps
-
 from target_s3.formats.format_base import FormatBase
-
-
-class JsonSerialize(JSONEncoder):
-    def default(self, obj: any) -> any:
-        if isinstance(obj, ObjectId):
-            return str(obj)
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        else:
-            raise TypeError(f"Type {type(obj)} not serializable")
+from target_s3.formats.json_encoder import get_encoder
 
 
 class FormatJsonl(FormatBase):
     def __init__(self, config, context) -> None:
         super().__init__(config, context, "jsonl")
-        pass
+        format_jsonl = self.format.get("format_jsonl", None) or {}
+        encode = get_encoder(format_jsonl.get("encoder", "auto"))
+        # the batch metadata columns are spliced into every encoded record
+        self.encode = self.with_metadata(encode)
 
     def _prepare_records(self):
         # use default behavior, no additional prep needed
         return super()._prepare_records()
 
     def _write(self) -> None:
-        return super()._write('\n'.join(map(dumps, self.records)))
+        return super()._write_chunks(self.serialize())
+
+    def serialize(self):
+        """Yields the records as JSON lines, a chunk of records at a time."""
+        for i, chunk in enumerate(self.chunk_records()):
+            text = b"\n".join(map(self.encode, chunk))
+            yield text if i == 0 else b"\n" + text
 
     def run(self) -> None:
         # use default behavior, no additional run steps needed
@@ -1,48 +1,312 @@
+import collections
+import hashlib
 import json
+import logging
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Tuple, Union
 
 import pyarrow
-from pyarrow import Table, fs
+import pyarrow.compute
+from pyarrow import Table, ipc
 from pyarrow.parquet import ParquetWriter
 
+from target_s3.formats.constants import (
+    DEFAULT_MAX_FILE_BYTES,
+    DEFAULT_MAX_OPEN_FILES,
+    PARQUET_COMPRESSION,
+    PARQUET_VERSIONS,
+)
 from target_s3.formats.format_base import FormatBase
+from target_s3.formats.json_encoder import get_encoder
+from target_s3.formats.partition import group_rows, partition_paths
+from target_s3.formats.schema_evolution import SchemaRegistry
+from target_s3.manifest import ColumnStats
+from target_s3.metrics import BatchMetrics
+from target_s3.spool import RecordCodec, SpooledRecords
+
+# rows converted at a time from a spooled batch, each becomes a row group
+SPOOL_CHUNK_ROWS = 64 * 1024
+
+
+def writer_options(format_parquet: dict) -> dict:
+    """The ParquetWriter properties set in the format_parquet config."""
+    ret = {
+        key: format_parquet[key]
+        for key in ("data_page_size", "write_statistics", "version")
+        if format_parquet.get(key, None) is not None
+    }
+    if format_parquet.get("version", None) is not None:
+        assert (
+            ret["version"] in PARQUET_VERSIONS
+        ), f"writer_options: Unknown parquet version {ret['version']}."
+    if format_parquet.get("dictionary_columns", None):
+        # only these columns are dictionary encoded
+        ret["use_dictionary"] = list(format_parquet["dictionary_columns"])
+    elif format_parquet.get("use_dictionary", None) is not None:
+        ret["use_dictionary"] = format_parquet["use_dictionary"]
+    return ret
+
+
+def supports_compression_level(compression: str) -> bool:
+    """Whether parquet takes a compression level for a codec, e.g. not for snappy."""
+    return compression != "none" and pyarrow.Codec.supports_compression_level(
+        compression
+    )
+
+
+def key_extension(compression: str) -> str:
+    """Parquet compresses inside the file, the codec goes before the extension."""
+    codec = PARQUET_COMPRESSION[compression]
+    return f"{codec}.parquet" if codec else "parquet"
+
+
+def create_process_pool(workers: int) -> ProcessPoolExecutor:
+    """Worker processes converting records to Arrow, shared by every stream."""
+    # spawned, forking would copy the upload threads and their locks
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+# conversion plans of a worker process, see FormatParquet.compile_schema
+_WORKER_CACHE = {}
+
+
+def convert_in_worker(
+    config: dict, stream_schema: dict, data: bytes, parse_decimals: bool
+) -> bytes:
+    """Converts JSON lines to an Arrow IPC stream in a worker process."""
+    client = FormatParquet.converter(
+        config, stream_schema, _WORKER_CACHE, logging.getLogger("target-s3")
+    )
+    client.records = client.codec(None, parse_decimals).decode_all(data)
+    table = client.create_dataframe()
+    sink = pyarrow.BufferOutputStream()
+    with ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue()
+
+
+class ParquetStreamWriter:
+    """Keeps one parquet file per stream open across batches.
+
+    Every batch is appended as one or more row groups. The file is closed and
+    a new object started once it reaches `max_file_bytes` or `max_file_rows`,
+    when the batch schema changes, and on `close`.
+    """
+
+    def __init__(
+        self,
+        logger,
+        compression: str = "gzip",
+        compression_level: int = None,
+        max_file_bytes: int = None,
+        max_file_rows: int = None,
+        row_group_size: int = None,
+        options: dict = None,
+        on_close=None,
+    ) -> None:
+        self.logger = logger
+        self.compression = compression
+        self.compression_level = compression_level
+        self.max_file_bytes = max_file_bytes
+        self.max_file_rows = max_file_rows
+        self.row_group_size = row_group_size
+        # further ParquetWriter properties, see writer_options
+        self.options = options or {}
+        # called with the key, footer metadata and size of every closed file
+        self.on_close = on_close
+        # batches of a stream may be written from several upload workers
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.key = None
+        self.stream = None
+        self.writer = None
+        self.rows = 0
+
+    def write(self, key: str, table: Table, open_output) -> tuple:
+        """Append a table to the open file, opening a new one at key if needed.
+
+        `open_output` opens the binary file object a new file is written to.
+
+        :return: bytes written and seconds spent waiting on the upload
+        """
+        with self.lock:
+            if self.writer and not self.writer.schema.equals(table.schema):
+                self.logger.info(f"schema changed, closing parquet file: {self.key}")
+                self._close()
+            position = None
+            if self.writer is None:
+                # counts the magic bytes the writer starts the file with
+                position = 0
+                self._open(key, table.schema, open_output)
+            stream = self.stream
+            if position is None:
+                position = stream.tell()
+            busy_seconds = stream.busy_seconds
+            self.writer.write_table(table, row_group_size=self.row_group_size)
+            self.rows += table.num_rows
+            if (self.max_file_rows and self.rows >= self.max_file_rows) or (
+                self.max_file_bytes and self.stream.tell() >= self.max_file_bytes
+            ):
+                self._close()
+            return stream.tell() - position, stream.busy_seconds - busy_seconds
+
+    @property
+    def is_open(self) -> bool:
+        return self.writer is not None
+
+    def close(self) -> tuple:
+        """Finalize the open file, if any.
+
+        :return: bytes written and seconds spent waiting on the upload
+        """
+        with self.lock:
+            return self._close()
+
+    def _open(self, key: str, schema: pyarrow.Schema, open_output) -> None:
+        # don't let a rolled file overwrite an earlier one from this stream
+        path, n = key, 1
+        folder, _, file_name = key.rpartition("/")
+        name, dot, extension = file_name.partition(".")
+        while path in self.keys:
+            path = f"{folder}/{name}-{n}{dot}{extension}"
+            n += 1
+        self.keys.add(path)
+        self.key = path
+        self.stream = open_output(path)
+        self.writer = ParquetWriter(
+            self.stream,
+            schema,
+            compression=self.compression,
+            compression_level=self.compression_level,
+            **self.options,
+        )
+        self.logger.info(f"opened parquet file: {path}")
+
+    def _close(self) -> tuple:
+        if self.writer is None:
+            return 0, 0.0
+        stream = self.stream
+        position, busy_seconds = stream.tell(), stream.busy_seconds
+        self.writer.close()
+        stream.close()
+        self.logger.info(f"closed parquet file: {self.key} ({self.rows} rows)")
+        if self.on_close:
+            self.on_close(self.key, self.writer.writer.metadata, stream.tell())
+        self.writer, self.stream, self.key, self.rows = None, None, None, 0
+        return stream.tell() - position, stream.busy_seconds - busy_seconds
 
 
 class FormatParquet(FormatBase):
+    compression_types = PARQUET_COMPRESSION
+
     def __init__(self, config, context) -> None:
         super().__init__(config, context, "parquet")
-        cloud_provider_config = config.get("cloud_provider", None)
-        cloud_provider_config_type = cloud_provider_config.get(
-            "cloud_provider_type", None
-        )
-        self.file_system = self.create_filesystem(
-            cloud_provider_config_type,
-            cloud_provider_config.get(cloud_provider_config_type, None),
-        )
+        if config.get("use_raw_stream_name"):
+            self.fully_qualified_key += f".{self.extension}"
         self.stream_schema = context.get("stream_schema", {})
         self.parquet_schema = None
+        # constant arrays of the metadata columns, see metadata_column
+        self.metadata_arrays = {}
+        # number of strings that needed surrogate repair in this batch
+        self.repaired_strings = 0
+        self.stream_cache = context["stream_cache"]
+        # one writer per stream and partition, shared by every batch, in the
+        # order they were last written to
+        self.stream_writers = self.stream_cache.setdefault(
+            "parquet_writers", collections.OrderedDict()
+        )
+        self.stream_writers_lock = self.stream_cache.setdefault(
+            "parquet_writers_lock", threading.Lock()
+        )
+        # the schema every batch of the stream is cast to, if enabled
+        format_parquet = self.format.get("format_parquet", None) or {}
+        self.unify_schema = format_parquet.get("unify_schema", False)
+        self.schema_registry = (
+            self.stream_cache.setdefault("parquet_schema_registry", SchemaRegistry())
+            if self.unify_schema
+            else None
+        )
 
-    def create_filesystem(
-        self,
-        cloud_provider: str,
-        cloud_provider_config: dict,
-    ) -> fs.FileSystem:
-        """Creates a pyarrow FileSystem object for accessing S3."""
-        try:
-            if cloud_provider == "aws":
-                return fs.S3FileSystem(
-                    access_key=self.session.get_credentials().access_key,
-                    secret_key=self.session.get_credentials().secret_key,
-                    session_token=self.session.get_credentials().token,
-                    region=self.session.region_name,
-                    endpoint_override=cloud_provider_config.get(
-                        "aws_endpoint_override", None
-                    ),
-                )
-        except Exception as e:
-            self.logger.error("Failed to create parquet file system.")
-            self.logger.error(e)
-            raise e
+    def supports_compression_level(self) -> bool:
+        return supports_compression_level(self.compression_codec)
+
+    def create_stream_writer(self, partition: str = "") -> ParquetStreamWriter:
+        format_parquet = self.format.get("format_parquet", None) or {}
+        on_close = None
+        if self.manifest:
+            manifest = self.manifest
+
+            def on_close(key, metadata, size):
+                stats = ColumnStats()
+                stats.add_parquet(metadata)
+                manifest.add(key, size, stats, partition)
+
+        return ParquetStreamWriter(
+            self.logger,
+            compression=self.compression_codec,
+            compression_level=self.compression_level,
+            max_file_bytes=format_parquet.get("max_file_bytes", DEFAULT_MAX_FILE_BYTES),
+            max_file_rows=format_parquet.get("max_file_rows", None),
+            row_group_size=format_parquet.get("row_group_size", None),
+            options=writer_options(format_parquet),
+            on_close=on_close,
+        )
+
+    @classmethod
+    def converter(
+        cls, config: dict, stream_schema: dict, stream_cache: dict, logger
+    ) -> "FormatParquet":
+        """A client that only converts records, without a connection or key."""
+        self = cls.__new__(cls)
+        self.config = config
+        self.format = config.get("format", None)
+        self.logger = logger
+        self.stream_schema = stream_schema
+        self.stream_cache = stream_cache
+        self.parquet_schema = None
+        self.repaired_strings = 0
+        format_parquet = self.format.get("format_parquet", None) or {}
+        self.unify_schema = format_parquet.get("unify_schema", False)
+        return self
+
+    def codec(self, encode, parse_decimals: bool) -> RecordCodec:
+        """Ships records to a worker process as JSON lines."""
+        return RecordCodec(encode, self.stream_schema, parse_decimals)
+
+    def build_table(self) -> Table:
+        """Converts the record set, in a worker process if there is a pool."""
+        process_pool = self.context.get("process_pool", None)
+        if process_pool is None:
+            return self.create_dataframe()
+        parse_decimals = self.context.get("parse_decimals", True)
+        data = self.codec(get_encoder(), parse_decimals).dumps(self.records)
+        ret = process_pool.submit(
+            # the target's config is a mappingproxy, which doesn't pickle
+            convert_in_worker,
+            dict(self.config),
+            self.stream_schema,
+            data,
+            parse_decimals,
+        ).result()
+        return ipc.open_stream(ret).read_all()
+
+    @classmethod
+    def finalize(cls, stream_cache: dict) -> BatchMetrics:
+        """Close the stream's open parquet files."""
+        metrics = BatchMetrics()
+        for stream_writer in stream_cache.get("parquet_writers", {}).values():
+            start = time.perf_counter()
+            written, upload_seconds = stream_writer.close()
+            # the footer, and the last pages of the file
+            metrics.seconds["serialize"] += time.perf_counter() - start - upload_seconds
+            metrics.seconds["upload"] += upload_seconds
+            metrics.output_bytes += written
+        return metrics
 
     def validate(self, schema: dict, field, value) -> dict:
         """
@@ -163,15 +427,20 @@ class FormatParquet(FormatBase):
         if isinstance(value, dict) and not value:
             # pyarrow can't process empty struct
             return None
-        if isinstance(value, str):
-            # pyarrow can't process empty struct
-            try:
-                return value.encode("utf-16", "surrogatepass").decode("utf-16")
-            except Exception as e:
-                self.logger.warning("surrogate encoding failed, serializing string")
-                return json.dumps(value)
+        if isinstance(value, str) and not value.isascii():
+            # ascii strings can't hold surrogates, only re-encode the others
+            return self.repair_string(value)
         return value
 
+    def repair_string(self, value: str) -> str:
+        """Joins surrogate pairs pyarrow can't encode, serializing lone surrogates."""
+        self.repaired_strings += 1
+        try:
+            return value.encode("utf-16", "surrogatepass").decode("utf-16")
+        except Exception as e:
+            self.logger.warning("surrogate encoding failed, serializing string")
+            return json.dumps(value)
+
     def create_schema(self) -> pyarrow.schema:
         """Generates schema from the records schema present in the tap.
         This is effective way to declare schema instead of relying on pyarrow to
@@ -332,52 +601,62 @@ class FormatParquet(FormatBase):
         properties = self.stream_schema.get("properties")
         parquet_schema = pyarrow.schema(get_schema_from_object(properties=properties))
 
-        # append process_date that is added in format_base
-        if self.config.get("include_process_date", None):
-            key = "_PROCESS_DATE"
-            parquet_schema = parquet_schema.append(
-                pyarrow.field(key, pyarrow.timestamp("s", tz="utc"))
-            )
-
         self.parquet_schema = parquet_schema
         return parquet_schema
 
+    def key_extension(self) -> str:
+        return key_extension(self.compression_codec)
+
+    def compile_schema(self) -> dict:
+        """Returns the conversion plan of the stream schema, compiled once per stream.
+
+        The plan holds the parquet schema and the struct type records are
+        converted with. It is cached in the stream cache, keyed by a hash of
+        the stream schema, so it is only rebuilt when the schema changes.
+
+        :return: conversion plan with keys `schema` and `type`
+        :rtype: dict
+        """
+        key = hashlib.sha1(
+            json.dumps(self.stream_schema, sort_keys=True, default=str).encode()
+        ).hexdigest()
+        plans = self.stream_cache.setdefault("parquet_schemas", {})
+        plan = plans.get(key)
+        if plan is None:
+            self.logger.info(f"parquet schema cache miss, compiling schema {key}")
+            parquet_schema = self.create_schema()
+            plan = plans[key] = {
+                "schema": parquet_schema,
+                "type": pyarrow.struct(parquet_schema),
+            }
+        else:
+            self.logger.info(f"parquet schema cache hit, reusing schema {key}")
+            self.parquet_schema = plan["schema"]
+        return plan
+
     def create_dataframe(self) -> Table:
         """Creates a pyarrow Table object from the record set."""
         try:
             format_parquet = self.format.get("format_parquet", None)
             if format_parquet and format_parquet.get("get_schema_from_tap", False):
-                parquet_schema = (
-                    self.parquet_schema if self.parquet_schema else self.create_schema()
-                )
-                fields = set([property.name for property in parquet_schema])
-                input = {
-                    f: [self.sanitize(row.get(f)) for row in self.records]
-                    for f in fields
-                }
-
-                ret = Table.from_pydict(mapping=input, schema=parquet_schema)
-            else:
+                ret = self.convert_records(self.compile_schema())
+            elif format_parquet and format_parquet.get("validate", None) == True:
                 fields = set()
                 for d in self.records:
                     fields = fields.union(d.keys())
-                if format_parquet and format_parquet.get("validate", None) == True:
-                    # NOTE: we may could use schema to build a pyarrow schema https://arrow.apache.org/docs/python/generated/pyarrow.Schema.html
-                    # and pass that into from_pydict(). The schema is inferred by pyarrow, but we could always be explicit about it.
-                    schema = dict()
-                    input = {
-                        f: [
-                            self.validate(schema, self.sanitize(f), row.get(f))
-                            for row in self.records
-                        ]
-                        for f in fields
-                    }
-                else:
-                    input = {
-                        f: [self.sanitize(row.get(f)) for row in self.records]
-                        for f in fields
-                    }
+                # NOTE: we may could use schema to build a pyarrow schema https://arrow.apache.org/docs/python/generated/pyarrow.Schema.html
+                # and pass that into from_pydict(). The schema is inferred by pyarrow, but we could always be explicit about it.
+                schema = dict()
+                input = {
+                    f: [
+                        self.validate(schema, self.sanitize(f), row.get(f))
+                        for row in self.records
+                    ]
+                    for f in fields
+                }
                 ret = Table.from_pydict(mapping=input)
+            else:
+                ret = self.convert_records()
 
         except Exception as e:
             self.logger.error("Failed to create parquet dataframe.")
@@ -386,19 +665,207 @@ class FormatParquet(FormatBase):
 
         return ret
 
+    def convert_records(self, plan: dict = None) -> Table:
+        """Converts the record set to a Table in a single pass over the records.
+
+        Records are handed to arrow as they are; only when arrow rejects them
+        are the columns built one by one, and only the columns that fail are
+        sanitized value by value.
+
+        :param plan: conversion plan from `compile_schema`, the schema is
+            inferred from the records if not given
+        :type plan: dict
+        :return: table of the record set
+        :rtype: pyarrow.Table
+        """
+        schema = plan["schema"] if plan else None
+        try:
+            if schema is not None:
+                # converting the rows as one struct array stays in C++ for every column
+                batch = pyarrow.RecordBatch.from_struct_array(
+                    pyarrow.array(self.records, type=plan["type"])
+                )
+                return self.drop_empty_structs(
+                    Table.from_batches([batch], schema=schema)
+                )
+            # struct inference visits every record, so it yields the union of all keys
+            batch = pyarrow.RecordBatch.from_struct_array(pyarrow.array(self.records))
+            return self.drop_empty_structs(Table.from_batches([batch]))
+        except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, UnicodeError) as e:
+            self.logger.info(f"falling back to column conversion: {e}")
+
+        if schema is not None:
+            fields = schema.names
+        else:
+            fields = list(dict.fromkeys(k for row in self.records for k in row))
+        columns = {}
+        for f in fields:
+            type = schema.field(f).type if schema is not None else None
+            values = [row.get(f) for row in self.records]
+            try:
+                columns[f] = pyarrow.array(values, type=type)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, UnicodeError):
+                if type is not None and pyarrow.types.is_string(type):
+                    # string columns only need their non-ascii values repaired
+                    values = [
+                        self.repair_string(value)
+                        if isinstance(value, str) and not value.isascii()
+                        else value
+                        for value in values
+                    ]
+                else:
+                    values = [self.sanitize(value) for value in values]
+                try:
+                    columns[f] = pyarrow.array(values, type=type)
+                except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+                    if type is not None or not self.unify_schema:
+                        raise
+                    # values of mixed types, strings like conflicts across batches
+                    columns[f] = pyarrow.array(
+                        [self.conflict_string(value) for value in values]
+                    )
+        if self.repaired_strings:
+            self.logger.info(
+                f"repaired {self.repaired_strings} string values with surrogates"
+            )
+        ret = Table.from_pydict(mapping=columns, schema=schema)
+        return self.drop_empty_structs(ret)
+
+    def conflict_string(self, value) -> str:
+        if value is None or isinstance(value, str):
+            return value
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, default=str)
+        return str(value)
+
+    def drop_empty_structs(self, table: Table) -> Table:
+        """Writes empty objects as nulls, as `sanitize` does.
+
+        Columns of empty structs, which parquet can't store, become null
+        columns. In other struct columns arrow turns `{}` into a struct of
+        null fields, those rows are masked as null.
+        """
+        for i, field in enumerate(table.schema):
+            if not pyarrow.types.is_struct(field.type):
+                continue
+            if field.type.num_fields == 0:
+                table = table.set_column(i, field.name, pyarrow.nulls(table.num_rows))
+                continue
+            empty = [row.get(field.name, None) == {} for row in self.records]
+            if not any(empty):
+                continue
+            column = table.column(i).combine_chunks()
+            mask = pyarrow.compute.or_(column.is_null(), pyarrow.array(empty))
+            table = table.set_column(
+                i,
+                field,
+                pyarrow.StructArray.from_arrays(
+                    column.flatten(), fields=list(field.type), mask=mask
+                ),
+            )
+        return table
+
     def _prepare_records(self):
         # use default behavior, no additional prep needed
         return super()._prepare_records()
 
-    def _write(self, contents: str = None) -> None:
-        df = self.create_dataframe()
+    def _write_partitions(self) -> None:
+        """Converts the batch once and writes one file per partition of the table."""
+        with self.metrics.timer("serialize"):
+            df = self.build_table()
+        columns = {
+            p["field"]: df.column(p["field"])
+            if p["field"] in df.column_names
+            else self.metadata_column(p["field"], df.num_rows)
+            if p["field"] in self.metadata
+            else pyarrow.nulls(df.num_rows)
+            for p in self.partition_by
+        }
+        with self.metrics.timer("prepare"):
+            groups = group_rows(partition_paths(columns, self.partition_by))
+        for path, indices in groups:
+            self._write(
+                df=df.take(indices),
+                key=self.partition_key(self.fully_qualified_key, path),
+                partition=path,
+            )
+
+    def metadata_column(self, name: str, rows: int) -> pyarrow.Array:
+        """A metadata column of `rows` rows, a zero-copy slice of the batch's array."""
+        array = self.metadata_arrays.get(name, None)
+        if array is None or len(array) < rows:
+            value = self.metadata[name]
+            format_parquet = self.format.get("format_parquet", None) or {}
+            if name == "_PROCESS_DATE" and format_parquet.get("get_schema_from_tap"):
+                # the type it always had in schemas compiled from the tap
+                value = pyarrow.scalar(value, pyarrow.timestamp("s", tz="utc"))
+            array = self.metadata_arrays[name] = pyarrow.repeat(value, rows)
+        return array.slice(0, rows)
+
+    def add_metadata(self, df: Table) -> Table:
+        """Appends the batch metadata columns, replacing record fields of that name."""
+        for name in self.metadata:
+            column = self.metadata_column(name, df.num_rows)
+            if name in df.column_names:
+                df = df.set_column(df.column_names.index(name), name, column)
+            else:
+                df = df.append_column(name, column)
+        return df
+
+    def sort(self, df: Table) -> Table:
+        """Sorts the rows by the `sort_by` columns, so row groups prune well."""
+        format_parquet = self.format.get("format_parquet", None) or {}
+        sort_keys = [
+            (column, "ascending")
+            for column in format_parquet.get("sort_by", None) or []
+            if column in df.column_names
+        ]
+        if not sort_keys:
+            return df
+        return df.take(pyarrow.compute.sort_indices(df, sort_keys=sort_keys))
+
+    def _write(self, df: Table = None, key: str = None, partition: str = "") -> None:
+        if df is None and isinstance(self.records, SpooledRecords):
+            # convert and append a chunk at a time, memory doesn't grow with the batch
+            records = self.records
+            chunks = self.metrics.timed(
+                "serialize", self.chunk_records(SPOOL_CHUNK_ROWS)
+            )
+            for chunk in chunks:
+                self.records = chunk
+                with self.metrics.timer("serialize"):
+                    df = self.build_table()
+                self._write(df, key, partition)
+            self.records = records
+            return
+        if df is None:
+            with self.metrics.timer("serialize"):
+                df = self.build_table()
+        with self.metrics.timer("prepare"):
+            df = self.add_metadata(df)
+            if self.schema_registry is not None:
+                df = self.schema_registry.unify(df)
+            df = self.sort(df)
+        # every partition keeps its own file open across batches
+        with self.stream_writers_lock:
+            stream_writer = self.stream_writers.get(partition)
+            if stream_writer is None:
+                stream_writer = self.create_stream_writer(partition)
+                self.stream_writers[partition] = stream_writer
+            self.stream_writers.move_to_end(partition)
+        self.close_idle_writers(stream_writer)
         try:
-            ParquetWriter(
-                f"{self.fully_qualified_key}.{self.extension}",
-                df.schema,
-                compression="gzip",  # TODO: support multiple compression types
-                filesystem=self.file_system,
-            ).write_table(df)
+            start = time.perf_counter()
+            written, upload_seconds = stream_writer.write(
+                key or self.fully_qualified_key, df, self.open_output
+            )
+            # parquet encodes and compresses pages as it writes them
+            self.metrics.seconds["serialize"] += (
+                time.perf_counter() - start - upload_seconds
+            )
+            self.metrics.seconds["upload"] += upload_seconds
+            self.metrics.serialized_bytes += df.nbytes
+            self.metrics.output_bytes += written
         except Exception as e:
             self.logger.error(e)
             if type(e) is pyarrow.lib.ArrowNotImplementedError:
@@ -409,6 +876,33 @@ class FormatParquet(FormatBase):
                 self.logger.error("Failed to write parquet file to S3.")
             raise e
 
+    def close_idle_writers(self, stream_writer: ParquetStreamWriter) -> None:
+        """Closes the least recently written files beyond `max_open_files`.
+
+        Every open file holds a multipart upload buffer, so a batch spanning
+        many partitions would otherwise keep them all until the next state.
+        The writers are kept, so a partition written to again starts a file
+        next to the ones it closed.
+        """
+        format_parquet = self.format.get("format_parquet", None) or {}
+        max_open_files = format_parquet.get("max_open_files", DEFAULT_MAX_OPEN_FILES)
+        with self.stream_writers_lock:
+            # least recently written first, leaving room for `stream_writer`
+            others = [
+                w
+                for w in self.stream_writers.values()
+                if w.is_open and w is not stream_writer
+            ]
+            idle = others[: max(len(others) - max(max_open_files, 1) + 1, 0)]
+        for writer in idle:
+            start = time.perf_counter()
+            written, upload_seconds = writer.close()
+            self.metrics.seconds["serialize"] += (
+                time.perf_counter() - start - upload_seconds
+            )
+            self.metrics.seconds["upload"] += upload_seconds
+            self.metrics.output_bytes += written
+
     def run(self) -> None:
         # use default behavior, no additional run steps needed
         return super().run(self.context["records"])
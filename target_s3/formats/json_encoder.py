@@ -0,0 +1,114 @@
+"""JSON encoder and decoder backends shared by the target and its formats.
+
+Every backend turns one record into UTF-8 bytes and handles the types the
+target hands out the same way: datetimes as ISO 8601 strings, Decimals as
+exact JSON numbers and bson ObjectIds as strings.
+"""
+
+from datetime import datetime
+from decimal import Decimal
+
+from simplejson import JSONEncoder, dumps
+
+ENCODERS = ["auto", "orjson", "msgspec", "simplejson"]
+
+
+class JsonSerialize(JSONEncoder):
+    def default(self, obj: any) -> any:
+        # bson is only imported once a record needs it, not on every start
+        from bson import ObjectId
+
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        else:
+            raise TypeError(f"Type {type(obj)} not serializable")
+
+
+def simplejson_encoder():
+    def encode(record) -> bytes:
+        return dumps(record, cls=JsonSerialize, use_decimal=True).encode("utf-8")
+
+    return encode
+
+
+def orjson_encoder():
+    import orjson
+    from bson import ObjectId
+
+    if not hasattr(orjson, "Fragment"):
+        raise ImportError("orjson>=3.9 is required to write exact decimals.")
+
+    def default(obj: any) -> any:
+        if isinstance(obj, Decimal):
+            # a fragment is written as is, keeping every digit
+            return orjson.Fragment(str(obj).encode("utf-8"))
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        raise TypeError(f"Type {type(obj)} not serializable")
+
+    fallback = simplejson_encoder()
+
+    def encode(record) -> bytes:
+        try:
+            return orjson.dumps(
+                record, default=default, option=orjson.OPT_PASSTHROUGH_DATETIME
+            )
+        except TypeError:
+            # e.g. integers beyond 64 bits, which orjson rejects
+            return fallback(record)
+
+    return encode
+
+
+def msgspec_encoder():
+    import msgspec
+    from bson import ObjectId
+
+    def enc_hook(obj: any) -> any:
+        if isinstance(obj, ObjectId):
+            return str(obj)
+        raise TypeError(f"Type {type(obj)} not serializable")
+
+    # NOTE: msgspec writes UTC datetimes with a `Z` suffix instead of `+00:00`
+    return msgspec.json.Encoder(enc_hook=enc_hook, decimal_format="number").encode
+
+
+def get_encoder(name: str = "auto"):
+    """Returns a function encoding one record as JSON bytes.
+
+    `auto` picks the fastest backend that is installed: orjson, msgspec and
+    then simplejson.
+    """
+    assert name in ENCODERS, f"get_encoder: Unknown json encoder {name}."
+    if name == "simplejson":
+        return simplejson_encoder()
+    if name == "orjson":
+        return orjson_encoder()
+    if name == "msgspec":
+        return msgspec_encoder()
+    for backend in (orjson_encoder, msgspec_encoder):
+        try:
+            return backend()
+        except (ImportError, TypeError):
+            continue
+    return simplejson_encoder()
+
+
+def get_fast_loads(parse_decimals: bool):
+    """Returns the fastest installed JSON parser keeping full precision, or None."""
+    try:
+        import msgspec
+
+        if parse_decimals:
+            # float literals are handed to Decimal as text, no precision is lost
+            return msgspec.json.Decoder(float_hook=Decimal).decode
+        return msgspec.json.decode
+    except (ImportError, TypeError):
+        # TypeError: msgspec before 0.18 has no float_hook
+        pass
+    # orjson isn't used, it reads integers beyond 64 bits as floats
+    return None
@@ -0,0 +1,82 @@
+"""Splits a batch into Hive-style partitions by record field values."""
+
+from __future__ import annotations
+
+import pyarrow
+import pyarrow.compute as pc
+
+from target_s3.formats.constants import PARTITION_GRAIN
+
+# the partition name Hive gives null values
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+def to_array(values) -> pyarrow.Array:
+    """Converts the values of a partition field, as strings if their types mix."""
+    if isinstance(values, pyarrow.ChunkedArray):
+        return values.combine_chunks()
+    if isinstance(values, pyarrow.Array):
+        return values
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError):
+        return pyarrow.array([None if v is None else str(v) for v in values])
+
+
+def partition_value(values, grain: str = None) -> pyarrow.Array:
+    """Formats one partition field as escaped strings, truncated to `grain`."""
+    values = to_array(values)
+    if grain:
+        fmt, length = PARTITION_GRAIN[grain]
+        if pyarrow.types.is_timestamp(values.type) and values.type.tz:
+            # partitions are in UTC, also spares looking up zones like "utc"
+            values = values.cast(pyarrow.timestamp(values.type.unit, "UTC"))
+        if pyarrow.types.is_temporal(values.type):
+            values = pc.strftime(values, format=fmt)
+        else:
+            # ISO 8601 strings are truncated as text
+            values = pc.utf8_slice_codeunits(
+                values.cast(pyarrow.string()), start=0, stop=length
+            )
+    elif not pyarrow.types.is_string(values.type):
+        values = values.cast(pyarrow.string())
+    # escape the characters that would break the object key, as Hive does
+    for char in ("%", "/", "="):
+        values = pc.replace_substring(values, char, f"%{ord(char):02X}")
+    return pc.fill_null(values, NULL_PARTITION)
+
+
+def partition_paths(columns: dict, partition_by: list) -> pyarrow.Array:
+    """Returns the `name=value/...` partition path of every row.
+
+    :param columns: values of every partition field, keyed by field name
+    :param partition_by: the `partition_by` config, a list of `field`,
+        optional `name` and optional `grain`
+    """
+    segments = []
+    for partition in partition_by:
+        field = partition["field"]
+        name = partition.get("name", None) or field
+        value = partition_value(columns[field], partition.get("grain", None))
+        segments.append(pc.binary_join_element_wise(f"{name}=", value, ""))
+    if len(segments) == 1:
+        return segments[0]
+    return pc.binary_join_element_wise(*segments, "/")
+
+
+def group_rows(paths: pyarrow.Array) -> list:
+    """Groups rows by partition path, without visiting rows in Python.
+
+    :return: `(path, row indices)` for every partition, rows kept in order
+    """
+    encoded = pc.dictionary_encode(paths)
+    # sort_indices is stable, so each partition keeps the batch's row order
+    order = pc.sort_indices(encoded.indices)
+    counts = pc.value_counts(encoded.indices.take(order))
+    ret, offset = [], 0
+    for code, count in zip(
+        counts.field("values").to_pylist(), counts.field("counts").to_pylist()
+    ):
+        ret.append((encoded.dictionary[code].as_py(), order.slice(offset, count)))
+        offset += count
+    return ret
@@ -0,0 +1,132 @@
+"""Unifies the Arrow schemas of the batches of a stream as they arrive."""
+
+from __future__ import annotations
+
+import json
+import threading
+
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.types as pt
+
+# widest decimal arrow writes to parquet
+MAX_DECIMAL_PRECISION = 38
+
+
+def unify_types(a: pyarrow.DataType, b: pyarrow.DataType) -> pyarrow.DataType:
+    """The type values of both `a` and `b` can be cast to, string on conflicts."""
+    if a.equals(b):
+        return a
+    if pt.is_null(a):
+        return b
+    if pt.is_null(b):
+        return a
+    if pt.is_integer(a) and pt.is_integer(b):
+        return pyarrow.int64()
+    if pt.is_decimal(a) and pt.is_decimal(b):
+        scale = max(a.scale, b.scale)
+        precision = max(a.precision - a.scale, b.precision - b.scale) + scale
+        if precision <= MAX_DECIMAL_PRECISION:
+            return pyarrow.decimal128(precision, scale)
+        return pyarrow.float64()
+    if is_number(a) and is_number(b):
+        return pyarrow.float64()
+    if pt.is_timestamp(a) and pt.is_timestamp(b) and a.tz == b.tz:
+        # the finer unit holds the values of both
+        units = ["s", "ms", "us", "ns"]
+        return pyarrow.timestamp(max(a.unit, b.unit, key=units.index), a.tz)
+    if pt.is_struct(a) and pt.is_struct(b):
+        return pyarrow.struct(unify_fields(list(a), list(b)))
+    if pt.is_list(a) and pt.is_list(b):
+        return pyarrow.list_(unify_types(a.value_type, b.value_type))
+    return pyarrow.string()
+
+
+def is_number(type: pyarrow.DataType) -> bool:
+    return pt.is_integer(type) or pt.is_floating(type) or pt.is_decimal(type)
+
+
+def unify_fields(a: list, b: list) -> list:
+    """Fields of `a` in order, unified with `b`, then the new fields of `b`."""
+    others = {field.name: field for field in b}
+    ret = []
+    for field in a:
+        other = others.pop(field.name, None)
+        type = field.type if other is None else unify_types(field.type, other.type)
+        # a column missing from a batch is written as nulls
+        ret.append(pyarrow.field(field.name, type, nullable=True))
+    ret += [pyarrow.field(f.name, f.type, nullable=True) for f in others.values()]
+    return ret
+
+
+def conform(values, type: pyarrow.DataType):
+    """Casts an array to `type`, filling missing struct fields with nulls."""
+    if isinstance(values, pyarrow.ChunkedArray):
+        return pyarrow.chunked_array(
+            [conform(chunk, type) for chunk in values.chunks], type=type
+        )
+    if values.type.equals(type):
+        return values
+    if pt.is_struct(type) and pt.is_struct(values.type):
+        # flatten accounts for the offset of a sliced array
+        children = dict(zip([f.name for f in values.type], values.flatten()))
+        children = [
+            conform(children[field.name], field.type)
+            if field.name in children
+            else pyarrow.nulls(len(values), field.type)
+            for field in type
+        ]
+        return pyarrow.StructArray.from_arrays(
+            children, fields=list(type), mask=values.is_null()
+        )
+    if pt.is_list(type) and pt.is_list(values.type):
+        # offsets index into values, which ignore the offset of a sliced array
+        offsets = values.offsets
+        start, end = offsets[0].as_py(), offsets[-1].as_py()
+        flat = conform(values.values.slice(start, end - start), type.value_type)
+        return pyarrow.ListArray.from_arrays(
+            pc.subtract(offsets, start), flat, type=type, mask=values.is_null()
+        )
+    if pt.is_string(type) and (pt.is_nested(values.type) or pt.is_binary(values.type)):
+        # arrow can't cast these to string, they are written as JSON
+        return pyarrow.array(
+            [
+                None if v is None else json.dumps(v, default=str)
+                for v in values.to_pylist()
+            ],
+            type=type,
+        )
+    return values.cast(type)
+
+
+class SchemaRegistry:
+    """The unified schema of a stream, every batch is cast to it.
+
+    Columns only ever get added or widened: new columns are added as
+    nullable, integers are promoted to floats and conflicting types fall
+    back to strings. A batch that already has the unified schema is
+    returned as is.
+    """
+
+    def __init__(self) -> None:
+        # batches of a stream may be written from several upload workers
+        self.lock = threading.Lock()
+        self.schema = None
+
+    def unify(self, table: pyarrow.Table) -> pyarrow.Table:
+        with self.lock:
+            schema = self.schema
+            if schema is not None and table.schema.equals(schema):
+                return table
+            if schema is None:
+                schema = pyarrow.schema(unify_fields(list(table.schema), []))
+            else:
+                schema = pyarrow.schema(unify_fields(list(schema), list(table.schema)))
+            self.schema = schema
+        columns = [
+            conform(table.column(field.name), field.type)
+            if field.name in table.column_names
+            else pyarrow.nulls(table.num_rows, field.type)
+            for field in schema
+        ]
+        return pyarrow.Table.from_arrays(columns, schema=schema)
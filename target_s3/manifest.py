@@ -0,0 +1,163 @@
+"""A manifest per stream and run, listing every object the target wrote.
+
+Readers find new data by reading one small object instead of listing the
+stream's prefix. The manifest is rewritten as a whole every time an object
+is completed, a single PUT, so readers always see a complete document.
+"""
+
+from __future__ import annotations
+
+import threading
+from datetime import date, datetime, time, timezone
+
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.types as pt
+from simplejson import dumps
+
+
+def to_json(value):
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    return str(value)
+
+
+def partition_values(path: str) -> dict:
+    """The `name: value` pairs of a `name=value/...` partition path."""
+    if not path:
+        return {}
+    return dict(segment.split("=", 1) for segment in path.split("/"))
+
+
+def object_entry(key: str, size: int, stats: "ColumnStats", partition: dict) -> dict:
+    """The manifest entry of one object."""
+    return {
+        "key": key,
+        "rows": stats.rows,
+        "bytes": size,
+        "partition": partition,
+        "columns": stats.to_dict(),
+    }
+
+
+def dump(document: dict) -> bytes:
+    return dumps(document, use_decimal=True, default=to_json).encode("utf-8")
+
+
+class ColumnStats:
+    """Min and max of the top level scalar columns of one object."""
+
+    def __init__(self) -> None:
+        self.rows = 0
+        self.columns = {}
+
+    def update(self, column: str, low, high) -> None:
+        if low is None or high is None:
+            return
+        current = self.columns.get(column, None)
+        try:
+            if current is None:
+                self.columns[column] = [low, high]
+            else:
+                current[0], current[1] = min(current[0], low), max(current[1], high)
+        except TypeError:
+            # values of mixed types have no order
+            self.columns[column] = [None, None]
+
+    def add_records(self, records: list) -> None:
+        """Adds a chunk of records, each column is converted by Arrow once."""
+        self.rows += len(records)
+        for column in dict.fromkeys(k for record in records for k in record):
+            values = [record.get(column, None) for record in records]
+            try:
+                array = pyarrow.array(values)
+            except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, UnicodeError):
+                self.columns[column] = [None, None]
+                continue
+            if (
+                pt.is_nested(array.type)
+                or pt.is_null(array.type)
+                or pt.is_boolean(array.type)
+            ):
+                continue
+            ret = pc.min_max(array)
+            self.update(column, ret["min"].as_py(), ret["max"].as_py())
+
+    def add_parquet(self, metadata) -> None:
+        """Adds the row group statistics of a parquet footer, nothing is read back."""
+        self.rows += metadata.num_rows
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                statistics = column.statistics
+                if (
+                    # nested fields are left out, as in add_records
+                    "." in column.path_in_schema
+                    or statistics is None
+                    or not statistics.has_min_max
+                    or statistics.physical_type == "BOOLEAN"
+                ):
+                    continue
+                self.update(column.path_in_schema, statistics.min, statistics.max)
+
+    def add_entries(self, entries: list) -> None:
+        """Adds the manifest entries of objects that were merged into one.
+
+        Only columns with a min and max in every entry are kept, an entry
+        leaves a column out when it has no order there.
+        """
+        if not entries:
+            return
+        self.rows += sum(entry["rows"] for entry in entries)
+        columns = set.intersection(*(set(entry["columns"]) for entry in entries))
+        for entry in entries:
+            for column in columns:
+                bounds = entry["columns"][column]
+                self.update(column, bounds["min"], bounds["max"])
+
+    def to_dict(self) -> dict:
+        return {
+            column: {"min": low, "max": high}
+            for column, (low, high) in self.columns.items()
+            if low is not None
+        }
+
+
+class Manifest:
+    """The objects written for one stream in one run.
+
+    Batches complete on several upload workers; the manifest is written
+    while holding a lock, so an older version never overwrites a newer one.
+    """
+
+    def __init__(self, client, bucket: str, key: str, stream: str, run_id: str) -> None:
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.lock = threading.Lock()
+        self.document = {
+            "stream": stream,
+            "run_id": run_id,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "updated_at": None,
+            "objects": [],
+        }
+
+    def add(
+        self, path: str, size: int, stats: ColumnStats, partition: str = ""
+    ) -> None:
+        """Lists a completed object at `bucket/key` `path`, rewriting the manifest."""
+        with self.lock:
+            self.document["objects"].append(
+                object_entry(
+                    path.partition("/")[2], size, stats, partition_values(partition)
+                )
+            )
+            self.document["updated_at"] = datetime.now(timezone.utc).isoformat()
+            self.client.put_object(
+                Bucket=self.bucket,
+                Key=self.key,
+                Body=dump(self.document),
+                ContentType="application/json",
+            )
@@ -0,0 +1,183 @@
+"""Per-batch and per-stream performance metrics.
+
+Every written batch is logged through the Singer SDK metrics logger, and
+the running totals of every stream are logged, and optionally written to a
+JSON or Prometheus textfile, whenever the target emits state.
+"""
+
+from __future__ import annotations
+
+import enum
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from singer_sdk import metrics
+
+STAGES = ["prepare", "serialize", "compress", "upload"]
+METRICS_FORMATS = ["json", "prometheus"]
+
+
+def escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metric(str, enum.Enum):
+    """Metric names of the target, logged like the SDK's own metrics."""
+
+    BATCH = "s3_batch"
+    STREAM = "s3_stream"
+
+
+class BatchMetrics:
+    """Counts and stage times of one batch, or the sum of several."""
+
+    def __init__(self) -> None:
+        self.batches = 0
+        self.records = 0
+        self.input_bytes = 0
+        self.serialized_bytes = 0
+        self.output_bytes = 0
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+
+    @contextmanager
+    def timer(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def timed(self, stage: str, iterable):
+        """Yields from `iterable`, adding the time spent producing items to `stage`."""
+        iterator = iter(iterable)
+        while True:
+            with self.timer(stage):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def add(self, other: "BatchMetrics") -> None:
+        self.batches += other.batches
+        self.records += other.records
+        self.input_bytes += other.input_bytes
+        self.serialized_bytes += other.serialized_bytes
+        self.output_bytes += other.output_bytes
+        for stage in STAGES:
+            self.seconds[stage] += other.seconds[stage]
+
+    @property
+    def compression_ratio(self) -> float:
+        if not self.output_bytes:
+            return None
+        return round(self.serialized_bytes / self.output_bytes, 3)
+
+    def to_dict(self) -> dict:
+        return {
+            "batches": self.batches,
+            "records": self.records,
+            "input_bytes": self.input_bytes,
+            "serialized_bytes": self.serialized_bytes,
+            "output_bytes": self.output_bytes,
+            "compression_ratio": self.compression_ratio,
+            "seconds": {stage: round(s, 6) for stage, s in self.seconds.items()},
+        }
+
+
+class MetricsRegistry:
+    """Running totals per stream, shared by every sink of a target."""
+
+    def __init__(self, path: str = None, format: str = "json") -> None:
+        assert (
+            format in METRICS_FORMATS
+        ), f"MetricsRegistry.__init__: Unknown metrics format {format}."
+        self.path = path
+        self.format = format
+        self.logger = metrics.get_metrics_logger()
+        # batches are recorded from the upload workers
+        self.lock = threading.Lock()
+        self.streams: dict[str, BatchMetrics] = {}
+
+    def add(self, stream: str, other: BatchMetrics) -> None:
+        """Add to a stream's totals, e.g. closing a file kept open across batches."""
+        with self.lock:
+            self.streams.setdefault(stream, BatchMetrics()).add(other)
+
+    def record(self, stream: str, batch: BatchMetrics) -> None:
+        """Add a written batch to its stream's totals and log it."""
+        self.add(stream, batch)
+        metrics.log(
+            self.logger,
+            metrics.Point("batch", Metric.BATCH, batch.to_dict(), {"stream": stream}),
+        )
+
+    def flush(self) -> None:
+        """Log every stream's totals and write them to the metrics file, if any."""
+        with self.lock:
+            streams = {name: totals.to_dict() for name, totals in self.streams.items()}
+        for name, totals in streams.items():
+            metrics.log(
+                self.logger,
+                metrics.Point("summary", Metric.STREAM, totals, {"stream": name}),
+            )
+        if not self.path:
+            return
+        text = (
+            self.prometheus(streams)
+            if self.format == "prometheus"
+            else json.dumps({"streams": streams}, indent=2)
+        )
+        # readers never see a half written file
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            f.write(text)
+        os.replace(tmp, self.path)
+
+    def prometheus(self, streams: dict) -> str:
+        """Formats the totals in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name: str, type: str, help: str, samples: list) -> None:
+            lines.append(f"# HELP target_s3_{name} {help}")
+            lines.append(f"# TYPE target_s3_{name} {type}")
+            for labels, value in samples:
+                labels = ",".join(f'{k}="{escape_label(v)}"' for k, v in labels.items())
+                lines.append(f"target_s3_{name}{{{labels}}} {value}")
+
+        for key, help in [
+            ("batches", "Batches written."),
+            ("records", "Records written."),
+            ("input_bytes", "Bytes of Singer messages read."),
+            ("serialized_bytes", "Bytes of serialized records, before compression."),
+            ("output_bytes", "Bytes of objects written."),
+        ]:
+            metric(
+                f"{key}_total",
+                "counter",
+                help,
+                [({"stream": s}, totals[key]) for s, totals in streams.items()],
+            )
+        metric(
+            "compression_ratio",
+            "gauge",
+            "Serialized bytes per written byte.",
+            [
+                ({"stream": s}, totals["compression_ratio"])
+                for s, totals in streams.items()
+                if totals["compression_ratio"] is not None
+            ],
+        )
+        metric(
+            "seconds_total",
+            "counter",
+            "Seconds spent per stage of writing batches.",
+            [
+                ({"stream": s, "stage": stage}, seconds)
+                for s, totals in streams.items()
+                for stage, seconds in totals["seconds"].items()
+            ],
+        )
+        return "\n".join(lines) + "\n"
@@ -1,19 +1,35 @@
 """s3 target sink class, which handles writing streams."""
 
 from __future__ import annotations
+
+import functools
+import importlib
+import json
 import logging
 
 from singer_sdk.sinks import BatchSink
 
 from target_s3.formats.format_base import FormatBase, format_type_factory
-from target_s3.formats.format_parquet import FormatParquet
-from target_s3.formats.format_csv import FormatCsv
-from target_s3.formats.format_json import FormatJson
-from target_s3.formats.format_jsonl import FormatJsonl
-
+from target_s3.formats.json_encoder import get_encoder
+from target_s3.spool import SpooledRecords
 
 LOGGER = logging.getLogger("target-s3")
-FORMAT_TYPE = {"parquet": FormatParquet, "csv": FormatCsv, "json": FormatJson, "jsonl": FormatJsonl}
+# format classes are imported on first use, most of them load pyarrow
+FORMAT_TYPE = {
+    "parquet": "target_s3.formats.format_parquet.FormatParquet",
+    "csv": "target_s3.formats.format_csv.FormatCsv",
+    "json": "target_s3.formats.format_json.FormatJson",
+    "jsonl": "target_s3.formats.format_jsonl.FormatJsonl",
+}
+# records kept in memory are encoded one in this many to estimate their size
+SIZE_SAMPLE_RATE = 16
+
+
+@functools.lru_cache(maxsize=None)
+def format_class(format_type: str) -> type:
+    """Imports the class of a format type listed in FORMAT_TYPE."""
+    module, _, name = FORMAT_TYPE[format_type].rpartition(".")
+    return getattr(importlib.import_module(module), name)
 
 
 class s3Sink(BatchSink):
@@ -30,6 +46,40 @@ class s3Sink(BatchSink):
         # what type of file are we building?
         self.format_type = self.config.get("format", None).get("format_type", None)
         self.schema = schema
+        # shared by every batch of every sink, see Targets3.connection
+        self.connection = target.connection
+        self.upload_pool = target.upload_pool
+        self.process_pool = target.process_pool
+        self.manifest = target.manifest(self.stream_name)
+        self.uploads = []
+        # objects formats keep across batches, e.g. an open parquet file
+        self.stream_cache = {}
+        # estimated serialized size of the pending batch
+        self.max_batch_bytes = self.config.get("max_batch_bytes", None)
+        self.batch_bytes = 0
+        # the other records count as the average of the sampled ones
+        self.records_sized = 0
+        self.sampled_records = 0
+        self.sampled_bytes = 0
+        # records wait in a local temp file instead of memory
+        self.spool_batches = self.config.get("spool_batches", False)
+        self.parse_decimals = target._parse_decimals
+        # totals shared by every sink, see Targets3.metrics
+        self.metrics = target.metrics
+        self.input_bytes = target.input_bytes
+        self.input_bytes_drained = 0
+        self.encode = (
+            get_encoder() if self.max_batch_bytes or self.spool_batches else None
+        )
+        # keep only the latest version of every primary key in a batch
+        self.dedupe_by = (
+            key_properties if self.config.get("dedupe_batches", False) else None
+        )
+        self.dedupe_order_by = self.config.get("dedupe_order_by", None)
+        if self.config.get("dedupe_batches", False) and not key_properties:
+            LOGGER.warning(
+                f"{stream_name} has no key properties, it isn't deduplicated"
+            )
         if self.format_type:
             if self.format_type not in FORMAT_TYPE:
                 raise Exception(
@@ -37,6 +87,8 @@ class s3Sink(BatchSink):
                 )
         else:
             raise Exception("No file type supplied.")
+        # imported here rather than from the upload workers
+        self.format_class = format_class(self.format_type)
 
     @property
     def max_size(self) -> int:
@@ -47,19 +99,144 @@ class s3Sink(BatchSink):
         """
         return self.config.get("max_batch_size", 10000)
 
+    @property
+    def is_full(self) -> bool:
+        """Check against the record count and the estimated byte size limits.
+
+        Returns:
+            True if the sink needs to be drained.
+        """
+        if self.max_batch_bytes and self.batch_bytes >= self.max_batch_bytes:
+            return True
+        return super().is_full
+
+    def process_record(self, record: dict, context: dict) -> None:
+        """Stage the record and add its serialized size to the batch estimate."""
+        replaced = None
+        if self.dedupe_by:
+            # position, order by value and size of the latest version of every key
+            index = context.setdefault("dedupe_index", {})
+            key = tuple(self.dedupe_value(record.get(k, None)) for k in self.dedupe_by)
+            order = (
+                record.get(self.dedupe_order_by, None) if self.dedupe_order_by else None
+            )
+            if key in index:
+                self.tally_duplicate_merged()
+                replaced, previous, previous_size = index[key]
+                if not self.is_newer(order, previous):
+                    return
+                # the older version is no longer written
+                self.batch_bytes -= previous_size
+        if self.spool_batches:
+            if "records" not in context:
+                compression = self.config.get("spool_compression", "none")
+                context["records"] = SpooledRecords(
+                    self.encode,
+                    self.schema,
+                    directory=self.config.get("spool_directory", None),
+                    compression=None if compression == "none" else compression,
+                    parse_decimals=self.parse_decimals,
+                )
+            spool = context["records"]
+            if replaced is not None:
+                # the spool is append only, the older version is skipped on read
+                spool.discard(replaced)
+            position = spool.count
+            size = spool.append(record)
+        else:
+            if replaced is not None:
+                # the latest version takes the place of the first
+                context["records"][replaced] = record
+                position = replaced
+            else:
+                position = len(context.get("records", []))
+                super().process_record(record, context)
+            size = self.record_size(record) if self.encode else 0
+        if self.dedupe_by:
+            index[key] = (position, order, size)
+        self.batch_bytes += size
+
+    def record_size(self, record: dict) -> int:
+        """Encodes one record in SIZE_SAMPLE_RATE, the others get the average."""
+        self.records_sized += 1
+        if self.sampled_records and self.records_sized % SIZE_SAMPLE_RATE:
+            return self.sampled_bytes // self.sampled_records
+        try:
+            size = len(self.encode(record))
+        except TypeError:
+            # types the json encoders don't know, a rough size is enough
+            size = len(repr(record))
+        self.sampled_records += 1
+        self.sampled_bytes += size
+        return size
+
+    def dedupe_value(self, value):
+        """Primary key values are hashed, objects and arrays as JSON."""
+        if isinstance(value, (dict, list)):
+            return json.dumps(value, sort_keys=True, default=str)
+        return value
+
+    def is_newer(self, order, previous) -> bool:
+        """Whether a version replaces the previous one; the last wins on ties."""
+        if order is None or previous is None:
+            return previous is None
+        try:
+            return order >= previous
+        except TypeError:
+            return True
+
     def process_batch(self, context: dict) -> None:
-        """Write out any prepped records and return once fully written."""
+        """Hand the batch off to the upload pool and return without waiting."""
         # add stream name to context
         context["stream_name"] = self.stream_name
         context["logger"] = self.logger
         context["stream_schema"] = self.schema
+        context["connection"] = self.connection
+        context["stream_cache"] = self.stream_cache
+        context["process_pool"] = self.process_pool
+        context["manifest"] = self.manifest
+        context["parse_decimals"] = self.parse_decimals
+        context["sync_started_at"] = self.sync_started_at
+        # bytes of the Singer messages read since the last batch
+        input_bytes = self.input_bytes[self.stream_name]
+        context["input_bytes"] = input_bytes - self.input_bytes_drained
+        self.input_bytes_drained = input_bytes
+        self.batch_bytes = 0
+        # blocks while the upload queue is full
+        future = self.upload_pool.submit(self.write_batch, context)
+        self.uploads = [f for f in self.uploads if not f.done()] + [future]
+
+    def write_batch(self, context: dict) -> None:
+        """Write out any prepped records and return once fully written."""
         # creates new object for each batch
         format_type_client = format_type_factory(
-            FORMAT_TYPE[self.format_type], self.config, context
+            self.format_class, self.config, context
         )
         # force base object_type_client to object_type_base class
         assert (
             isinstance(format_type_client, FormatBase) is True
         ), f"format_type_client must be of type Base; Type: {type(self.format_type_client)}."
 
-        format_type_client.run()
+        try:
+            format_type_client.run()
+        finally:
+            if isinstance(context.get("records", None), SpooledRecords):
+                context["records"].close()
+        batch = format_type_client.metrics
+        batch.batches = 1
+        batch.records = len(context["records"])
+        batch.input_bytes = context["input_bytes"]
+        self.metrics.record(self.stream_name, batch)
+
+    def finalize(self) -> None:
+        """Wait for this stream's pending uploads and close any open files."""
+        self.upload_pool.wait(self.uploads)
+        self.uploads = []
+        closed = self.format_class.finalize(self.stream_cache)
+        if closed:
+            self.metrics.add(self.stream_name, closed)
+
+    def clean_up(self) -> None:
+        """Finalize the stream before the sink is retired."""
+        self.finalize()
+        super().clean_up()
@@ -0,0 +1,154 @@
+"""Spools the records of a batch to a local temp file instead of memory."""
+
+from __future__ import annotations
+
+import json
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+
+from target_s3.formats.compression import open_compressor, open_decompressor
+from target_s3.formats.json_encoder import get_fast_loads
+
+# size of the blocks a spool file is read in
+READ_BLOCK_SIZE = 1024 * 1024
+
+
+def datelike_fields(schema: dict) -> list:
+    """Top level fields the SDK parses into datetimes.
+
+    See Sink._parse_timestamps_in_record.
+    """
+    ret = []
+    for key, value in schema.get("properties", {}).items():
+        types = value.get("anyOf", [value])
+        if any(t.get("format") in ("date-time", "date", "time") for t in types):
+            ret.append(key)
+    return ret
+
+
+class RecordCodec:
+    """Encodes records as JSON lines and decodes them as they were on input.
+
+    Floats are parsed the way Targets3.deserialize_json parsed them and the
+    SDK's datetimes are parsed again.
+    """
+
+    def __init__(self, encode, schema: dict, parse_decimals: bool = True) -> None:
+        self.encode = encode
+        self.datelike_fields = datelike_fields(schema)
+        self.parse_decimals = parse_decimals
+        self.loads = get_fast_loads(parse_decimals)
+
+    def dumps(self, records: list) -> bytes:
+        return b"\n".join(self.encode(record) for record in records)
+
+    def decode_all(self, data: bytes) -> list:
+        return [self.restore(self.decode(line)) for line in data.split(b"\n") if line]
+
+    def decode(self, line: bytes) -> dict:
+        if self.loads:
+            try:
+                return self.loads(line)
+            except ValueError:
+                # e.g. NaN, which only the standard library accepts
+                pass
+        if self.parse_decimals:
+            return json.loads(line, parse_float=Decimal)
+        return json.loads(line)
+
+    def restore(self, record: dict) -> dict:
+        """Parses the ISO 8601 strings the SDK's datetimes were encoded as."""
+        for key in self.datelike_fields:
+            value = record.get(key, None)
+            if isinstance(value, str):
+                try:
+                    record[key] = datetime.fromisoformat(value.replace("Z", "+00:00"))
+                except ValueError:
+                    pass
+        return record
+
+
+class SpooledRecords:
+    """The records of one batch, kept as JSON lines in a temp file.
+
+    Records are encoded as they arrive, so memory doesn't grow with the
+    batch. They are read back a chunk at a time with `chunks`, decoded by
+    a `RecordCodec`.
+    """
+
+    def __init__(
+        self,
+        encode,
+        schema: dict,
+        directory: str = None,
+        compression: str = None,
+        parse_decimals: bool = True,
+    ) -> None:
+        self.codec = RecordCodec(encode, schema, parse_decimals)
+        self.compression = compression
+        # unlinked right away on posix, the space is freed once it's closed
+        self.file = tempfile.TemporaryFile(dir=directory, prefix="target-s3-")
+        # the spool is read back once, so the fastest level is enough
+        self.writer = (
+            open_compressor(self.file, compression, 1) if compression else self.file
+        )
+        self.count = 0
+        # positions of records left out on read, see discard
+        self.discarded = set()
+
+    def __len__(self) -> int:
+        return self.count - len(self.discarded)
+
+    def discard(self, position: int) -> None:
+        """Leaves out the record appended at `position` when reading back."""
+        self.discarded.add(position)
+
+    def append(self, record: dict) -> int:
+        """Spools one record and returns its encoded size."""
+        line = self.codec.encode(record)
+        self.writer.write(line + b"\n")
+        self.count += 1
+        return len(line)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+    def chunks(self, size: int = 1000):
+        """Yields the records in lists of at most `size`."""
+        if self.writer is not self.file:
+            # flushes the codec, the temp file stays open
+            self.writer.close()
+            self.writer = self.file
+        self.file.flush()
+        self.file.seek(0)
+        chunk = []
+        codec = self.codec
+        discarded = self.discarded
+        with open_decompressor(self.file, self.compression) as f:
+            for position, line in enumerate(self.lines(f)):
+                if discarded and position in discarded:
+                    continue
+                chunk.append(codec.restore(codec.decode(line)))
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def lines(self, f):
+        rest = b""
+        while True:
+            block = f.read(READ_BLOCK_SIZE)
+            if not block:
+                break
+            lines = (rest + block).split(b"\n")
+            rest = lines.pop()
+            yield from lines
+        if rest:
+            yield rest
+
+    def close(self) -> None:
+        """Deletes the spool file."""
+        self.file.close()
@@ -1,17 +1,42 @@
 """s3 target class."""
 
 from __future__ import annotations
+
+import collections
 import decimal
 import json
+import sys
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import TYPE_CHECKING
 
-from singer_sdk.target_base import Target
 from singer_sdk import typing as th
+from singer_sdk.target_base import Target
 
-from target_s3.formats.format_base import DATE_GRAIN
-
-from target_s3.sinks import (
-    s3Sink,
+from target_s3.connection import DEFAULT_UPLOAD_CONCURRENCY, S3Connection
+from target_s3.formats.constants import (
+    DEFAULT_MAX_FILE_BYTES,
+    DEFAULT_MAX_OPEN_FILES,
+    NESTED_VALUES,
+    PARQUET_COMPRESSION,
+    PARQUET_VERSIONS,
+    PARTITION_GRAIN,
 )
+from target_s3.formats.format_base import COMPRESSION, DATE_GRAIN
+from target_s3.formats.json_encoder import ENCODERS, get_fast_loads
+from target_s3.metrics import METRICS_FORMATS, MetricsRegistry
+from target_s3.sinks import s3Sink
+from target_s3.upload import (
+    DEFAULT_MULTIPART_CONCURRENCY,
+    DEFAULT_MULTIPART_PART_SIZE,
+    DEFAULT_MULTIPART_THRESHOLD,
+    DEFAULT_UPLOAD_QUEUE_DEPTH,
+    UploadPool,
+)
+
+if TYPE_CHECKING:
+    from target_s3.manifest import Manifest
 
 
 class Targets3(Target):
@@ -30,6 +55,7 @@ class Targets3(Target):
                         "parquet",
                         "json",
                         "jsonl",
+                        "csv",
                     ],  # TODO: configure this from class
                 ),
                 th.Property(
@@ -52,17 +78,228 @@ class Targets3(Target):
                                          not defined at element level. Doesn't work with \
                                          validate option for now."
                         ),
+                        th.Property(
+                            "process_pool_size",
+                            th.IntegerType,
+                            required=False,
+                            default=0,
+                            description=(
+                                "Number of worker processes converting records to "
+                                "Arrow, shared by every stream. 0 converts in the "
+                                "upload workers."
+                            ),
+                        ),
+                        th.Property(
+                            "max_file_bytes",
+                            th.IntegerType,
+                            required=False,
+                            default=DEFAULT_MAX_FILE_BYTES,
+                            description=(
+                                "Size in bytes at which the open parquet file of a "
+                                "stream is closed and a new one is started."
+                            ),
+                        ),
+                        th.Property(
+                            "max_file_rows",
+                            th.IntegerType,
+                            required=False,
+                            description=(
+                                "Number of rows at which the open parquet file of a "
+                                "stream is closed and a new one is started."
+                            ),
+                        ),
+                        th.Property(
+                            "max_open_files",
+                            th.IntegerType,
+                            required=False,
+                            default=DEFAULT_MAX_OPEN_FILES,
+                            description=(
+                                "Number of partition files a stream keeps open, "
+                                "the least recently written one is closed first."
+                            ),
+                        ),
+                        th.Property(
+                            "compression",
+                            th.StringType,
+                            required=False,
+                            default="gzip",
+                            allowed_values=list(PARQUET_COMPRESSION.keys()),
+                            description="Compression codec of the parquet pages.",
+                        ),
+                        th.Property(
+                            "compression_level",
+                            th.IntegerType,
+                            required=False,
+                            description=(
+                                "Level of the compression codec, if it has levels."
+                            ),
+                        ),
+                        th.Property(
+                            "row_group_size",
+                            th.IntegerType,
+                            required=False,
+                            description="Maximum number of rows per row group.",
+                        ),
+                        th.Property(
+                            "data_page_size",
+                            th.IntegerType,
+                            required=False,
+                            description="Target size in bytes of the data pages.",
+                        ),
+                        th.Property(
+                            "use_dictionary",
+                            th.BooleanType,
+                            required=False,
+                            default=True,
+                            description="Dictionary encode the columns.",
+                        ),
+                        th.Property(
+                            "dictionary_columns",
+                            th.ArrayType(th.StringType),
+                            required=False,
+                            description="Dictionary encode only these columns.",
+                        ),
+                        th.Property(
+                            "write_statistics",
+                            th.BooleanType,
+                            required=False,
+                            default=True,
+                            description="Write min/max and null count statistics.",
+                        ),
+                        th.Property(
+                            "version",
+                            th.StringType,
+                            required=False,
+                            default="2.6",
+                            allowed_values=PARQUET_VERSIONS,
+                            description="Parquet format version.",
+                        ),
+                        th.Property(
+                            "unify_schema",
+                            th.BooleanType,
+                            required=False,
+                            default=False,
+                            description=(
+                                "Cast every batch to the schema of all batches of the "
+                                "stream so far."
+                            ),
+                        ),
+                        th.Property(
+                            "sort_by",
+                            th.ArrayType(th.StringType),
+                            required=False,
+                            description=(
+                                "Columns the rows of every batch are sorted by before "
+                                "writing."
+                            ),
+                        ),
                     ),
                     required=False,
                 ),
                 th.Property(
                     "format_json",
-                    th.ObjectType(),
+                    th.ObjectType(
+                        th.Property(
+                            "compression",
+                            th.StringType,
+                            required=False,
+                            default="gzip",
+                            allowed_values=list(COMPRESSION.keys()),
+                            description="Compression codec of the object.",
+                        ),
+                        th.Property(
+                            "compression_level",
+                            th.IntegerType,
+                            required=False,
+                            description="Level of the compression codec.",
+                        ),
+                        th.Property(
+                            "encoder",
+                            th.StringType,
+                            required=False,
+                            default="auto",
+                            allowed_values=ENCODERS,
+                            description=(
+                                "JSON encoder backend, auto picks the fastest "
+                                "installed."
+                            ),
+                        ),
+                    ),
+                    required=False,
+                ),
+                th.Property(
+                    "format_jsonl",
+                    th.ObjectType(
+                        th.Property(
+                            "compression",
+                            th.StringType,
+                            required=False,
+                            default="gzip",
+                            allowed_values=list(COMPRESSION.keys()),
+                            description="Compression codec of the object.",
+                        ),
+                        th.Property(
+                            "compression_level",
+                            th.IntegerType,
+                            required=False,
+                            description="Level of the compression codec.",
+                        ),
+                        th.Property(
+                            "encoder",
+                            th.StringType,
+                            required=False,
+                            default="auto",
+                            allowed_values=ENCODERS,
+                            description=(
+                                "JSON encoder backend, auto picks the fastest "
+                                "installed."
+                            ),
+                        ),
+                    ),
                     required=False,
                 ),
                 th.Property(
                     "format_csv",
-                    th.ObjectType(),
+                    th.ObjectType(
+                        th.Property(
+                            "delimiter",
+                            th.StringType,
+                            required=False,
+                            default=",",
+                            description="Single character separating the fields.",
+                        ),
+                        th.Property(
+                            "include_header",
+                            th.BooleanType,
+                            required=False,
+                            default=True,
+                            description="Write the column names as the first line.",
+                        ),
+                        th.Property(
+                            "nested_values",
+                            th.StringType,
+                            required=False,
+                            default="json",
+                            allowed_values=NESTED_VALUES,
+                            description=(
+                                "Write objects and arrays as JSON or leave them empty."
+                            ),
+                        ),
+                        th.Property(
+                            "compression",
+                            th.StringType,
+                            required=False,
+                            default="gzip",
+                            allowed_values=list(COMPRESSION.keys()),
+                            description="Compression codec of the object.",
+                        ),
+                        th.Property(
+                            "compression_level",
+                            th.IntegerType,
+                            required=False,
+                            description="Level of the compression codec.",
+                        ),
+                    ),
                     required=False,
                 ),
             ),
@@ -135,7 +372,37 @@ class Targets3(Target):
         th.Property(
             "include_process_date",
             th.BooleanType,
-            description="A flag indicating whether to append _process_date to record.",
+            description=(
+                "A flag indicating whether to append _PROCESS_DATE, the time the batch "
+                "is written, to every record."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "include_batch_id",
+            th.BooleanType,
+            description=(
+                "A flag indicating whether to append _BATCH_ID, the id of the batch, to"
+                " every record."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "include_stream_name",
+            th.BooleanType,
+            description=(
+                "A flag indicating whether to append _STREAM_NAME, the source stream, "
+                "to every record."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "include_sdc_batch_metadata",
+            th.BooleanType,
+            description=(
+                "A flag indicating whether to append the Singer _sdc_batched_at and "
+                "_sdc_sync_started_at columns to every record."
+            ),
             default=False,
         ),
         th.Property(
@@ -169,6 +436,15 @@ class Targets3(Target):
             description="A flag to append the date to the key filename.",
             default=True,
         ),
+        th.Property(
+            "append_batch_id_to_filename",
+            th.BooleanType,
+            description=(
+                "A flag to append the batch id to the key filename, so batches never "
+                "overwrite each other."
+            ),
+            default=True,
+        ),
         th.Property(
             "append_date_to_filename_grain",
             th.StringType,
@@ -176,6 +452,40 @@ class Targets3(Target):
             allowed_values=DATE_GRAIN.keys(),
             default="day",
         ),
+        th.Property(
+            "partition_by",
+            th.ArrayType(
+                th.ObjectType(
+                    th.Property(
+                        "field",
+                        th.StringType,
+                        required=True,
+                        description="Record field the objects are partitioned by.",
+                    ),
+                    th.Property(
+                        "name",
+                        th.StringType,
+                        required=False,
+                        description=(
+                            "Name of the partition in the key, the field name by "
+                            "default."
+                        ),
+                    ),
+                    th.Property(
+                        "grain",
+                        th.StringType,
+                        required=False,
+                        allowed_values=list(PARTITION_GRAIN.keys()),
+                        description="Truncate a date or timestamp field to this grain.",
+                    ),
+                )
+            ),
+            description=(
+                "Record fields each batch is split by into Hive-style partitions, e.g. "
+                "'event_date=2023-01-01'."
+            ),
+            required=False,
+        ),
         th.Property(
             "max_batch_age",
             th.NumberType,
@@ -190,10 +500,238 @@ class Targets3(Target):
             required=False,
             default=10000,
         ),
+        th.Property(
+            "max_batch_bytes",
+            th.IntegerType,
+            description=(
+                "Estimated serialized size in bytes at which a batch is written, "
+                "whichever of this and max_batch_size is hit first."
+            ),
+            required=False,
+        ),
+        th.Property(
+            "dedupe_batches",
+            th.BooleanType,
+            description=(
+                "Keep only the latest version of every primary key within a batch."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "dedupe_order_by",
+            th.StringType,
+            description=(
+                "Field deciding the latest version, e.g. the replication key. The last "
+                "one read by default."
+            ),
+            required=False,
+        ),
+        th.Property(
+            "spool_batches",
+            th.BooleanType,
+            description=(
+                "Keep the records of a batch in a local temp file instead of memory."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "spool_directory",
+            th.StringType,
+            description=(
+                "Directory of the spool files, the system temp directory by default."
+            ),
+            required=False,
+        ),
+        th.Property(
+            "spool_compression",
+            th.StringType,
+            description="Compression codec of the spool files.",
+            allowed_values=list(COMPRESSION.keys()),
+            default="none",
+        ),
+        th.Property(
+            "write_manifest",
+            th.BooleanType,
+            description=(
+                "Keep a manifest of every object written per stream and run at "
+                "'<prefix>/<stream>/_manifests/<run id>.json'."
+            ),
+            default=False,
+        ),
+        th.Property(
+            "metrics_file",
+            th.StringType,
+            description=(
+                "Local file the per stream metrics are written to whenever state is "
+                "emitted."
+            ),
+            required=False,
+        ),
+        th.Property(
+            "metrics_format",
+            th.StringType,
+            description=(
+                "Format of the metrics file, 'prometheus' for the node exporter's "
+                "textfile collector."
+            ),
+            allowed_values=METRICS_FORMATS,
+            default="json",
+        ),
+        th.Property(
+            "upload_concurrency",
+            th.IntegerType,
+            description=(
+                "Maximum number of batches uploaded at once, also sizes the connection "
+                "pool."
+            ),
+            required=False,
+            default=DEFAULT_UPLOAD_CONCURRENCY,
+        ),
+        th.Property(
+            "upload_queue_depth",
+            th.IntegerType,
+            description=(
+                "Maximum number of batches waiting for an upload worker before reading "
+                "input is paused."
+            ),
+            required=False,
+            default=DEFAULT_UPLOAD_QUEUE_DEPTH,
+        ),
+        th.Property(
+            "multipart_part_size",
+            th.IntegerType,
+            description=(
+                "Size in bytes of each part of a multipart upload, at least 5 MiB."
+            ),
+            required=False,
+            default=DEFAULT_MULTIPART_PART_SIZE,
+        ),
+        th.Property(
+            "multipart_threshold",
+            th.IntegerType,
+            description="Object size in bytes from which multipart uploads are used.",
+            required=False,
+            default=DEFAULT_MULTIPART_THRESHOLD,
+        ),
+        th.Property(
+            "multipart_concurrency",
+            th.IntegerType,
+            description="Maximum number of parts of one object uploaded at once.",
+            required=False,
+            default=DEFAULT_MULTIPART_CONCURRENCY,
+        ),
     ).to_dict()
 
     default_sink_class = s3Sink
 
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._connection = None
+        self._upload_pool = None
+        self._process_pool = None
+        # decided once instead of on every line, see deserialize_json
+        format_parquet = self.config.get("format", {}).get("format_parquet", None)
+        self._parse_decimals = not (
+            format_parquet and format_parquet.get("get_schema_from_tap", False)
+        )
+        self._fast_loads = get_fast_loads(self._parse_decimals)
+        # every sink that may still hold open files, including retired ones
+        self._sinks_to_finalize = []
+        # per stream totals, written out whenever state is emitted
+        self.metrics = MetricsRegistry(
+            self.config.get("metrics_file", None),
+            self.config.get("metrics_format", "json"),
+        )
+        # size of the Singer messages read per stream, see deserialize_json
+        self.input_bytes = collections.Counter()
+        # one manifest per stream, shared by every sink of the stream
+        self._manifests = {}
+        self._run_id = (
+            f"{datetime.now(timezone.utc):%Y%m%dT%H%M%SZ}-{uuid.uuid4().hex[:8]}"
+        )
+
+    @property
+    def connection(self) -> S3Connection:
+        """The session, client and file system shared by all sinks."""
+        if self._connection is None:
+            self._connection = S3Connection(self.config)
+        return self._connection
+
+    @property
+    def upload_pool(self) -> UploadPool:
+        """The background workers shared by all sinks."""
+        if self._upload_pool is None:
+            self._upload_pool = UploadPool(
+                workers=int(
+                    self.config.get("upload_concurrency", DEFAULT_UPLOAD_CONCURRENCY)
+                ),
+                queue_depth=int(
+                    self.config.get("upload_queue_depth", DEFAULT_UPLOAD_QUEUE_DEPTH)
+                ),
+            )
+        return self._upload_pool
+
+    @property
+    def process_pool(self) -> ProcessPoolExecutor:
+        """The worker processes converting parquet batches, if configured."""
+        format = self.config.get("format", {})
+        format_parquet = format.get("format_parquet", None) or {}
+        workers = format_parquet.get("process_pool_size", 0)
+        if format.get("format_type", None) != "parquet" or not workers:
+            return None
+        if self._process_pool is None:
+            # imported on use, it loads pyarrow
+            from target_s3.formats.format_parquet import create_process_pool
+
+            self._process_pool = create_process_pool(int(workers))
+        return self._process_pool
+
+    def manifest(self, stream_name: str) -> Manifest:
+        """The manifest of the objects written for a stream in this run, if enabled."""
+        if not self.config.get("write_manifest", False):
+            return None
+        if stream_name not in self._manifests:
+            from target_s3.manifest import Manifest
+
+            stream = self.config.get("stream_name_path_override", None) or stream_name
+            prefix = self.config.get("prefix", None)
+            key = f"{stream}/_manifests/{self._run_id}.json"
+            self._manifests[stream_name] = Manifest(
+                self.connection.client,
+                self.connection.aws_config.get("aws_bucket", None),
+                f"{prefix}/{key}" if prefix else key,
+                stream_name,
+                self._run_id,
+            )
+        return self._manifests[stream_name]
+
+    def add_sink(self, *args, **kwargs) -> s3Sink:
+        sink = super().add_sink(*args, **kwargs)
+        self._sinks_to_finalize.append(sink)
+        return sink
+
+    def _write_state_message(self, state: dict) -> None:
+        """Emit state only once every file covering it is written and closed."""
+        self.upload_pool.wait()
+        for sink in self._sinks_to_finalize:
+            sink.finalize()
+        active = list(self._sinks_active.values())
+        self._sinks_to_finalize = [s for s in self._sinks_to_finalize if s in active]
+        self.metrics.flush()
+        super()._write_state_message(state)
+
+    def _process_endofpipe(self) -> None:
+        """Drain every sink, then stop the upload and conversion workers."""
+        try:
+            super()._process_endofpipe()
+        finally:
+            if self._upload_pool is not None:
+                self._upload_pool.shutdown()
+                self._upload_pool = None
+            if self._process_pool is not None:
+                self._process_pool.shutdown()
+                self._process_pool = None
+
     @property
     def _MAX_RECORD_AGE_IN_MINUTES(self) -> float:  # type: ignore
         return float(self.config.get("max_batch_age", 5.0))
@@ -202,24 +740,46 @@ class Targets3(Target):
         """Override base target's method to overcome Decimal cast,
         only applied when generating parquet schema from tap schema.
 
+        The format decision is made once at startup. msgspec is used when
+        installed, falling back to the standard library for what it
+        rejects, e.g. NaN.
+
         :param line: serialized record from stream
         :type line: str
         :return: deserialized record
         :rtype: dict
         """
+        message = self._loads(line)
+        if isinstance(message, dict):
+            self.input_bytes[message.get("stream", None)] += len(line)
+        return message
+
+    def _loads(self, line: str) -> dict:
         try:
-            self.format = self.config.get("format", None)
-            format_parquet = self.format.get("format_parquet", None)
-            if format_parquet and format_parquet.get("get_schema_from_tap", False):
-                return json.loads(line)  # type: ignore[no-any-return]
-            else:
+            if self._fast_loads:
+                try:
+                    return self._fast_loads(line)
+                except ValueError:
+                    # e.g. NaN, which only the standard library accepts
+                    pass
+            if self._parse_decimals:
                 return json.loads(  # type: ignore[no-any-return]
                     line, parse_float=decimal.Decimal
                 )
+            return json.loads(line)  # type: ignore[no-any-return]
         except json.decoder.JSONDecodeError as exc:
             self.logger.error("Unable to parse:\n%s", line, exc_info=exc)
             raise
 
 
+def cli() -> None:
+    """Runs the target, or `target-s3 compact` to merge small objects."""
+    if sys.argv[1:2] == ["compact"]:
+        from target_s3.compact import cli as compact_cli
+
+        return compact_cli(sys.argv[2:], prog_name="target-s3 compact")
+    return Targets3.cli()
+
+
 if __name__ == "__main__":
-    Targets3.cli()
+    cli()
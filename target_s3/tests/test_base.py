@@ -0,0 +1,282 @@
+"""Tests the json and csv formats and the format base without an object store."""
+
+from __future__ import annotations
+
+import io
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+from bson import ObjectId
+from simplejson import dumps, loads
+
+from target_s3.formats import format_base
+from target_s3.formats.compression import open_compressor, open_decompressor
+from target_s3.formats.format_csv import FormatCsv
+from target_s3.formats.format_json import FormatJson
+from target_s3.formats.format_jsonl import FormatJsonl
+from target_s3.formats.json_encoder import JsonSerialize, get_encoder
+from target_s3.formats.partition import partition_paths
+from target_s3.tests import test_core
+
+
+def format_client(
+    format_class,
+    records: list,
+    config: dict = None,
+    stream_schema: dict = None,
+    connection=None,
+):
+    config = dict(
+        test_core.SAMPLE_CONFIG,
+        append_date_to_prefix=True,
+        append_date_to_prefix_grain="day",
+        partition_name_enabled=False,
+        append_date_to_filename=True,
+        append_date_to_filename_grain="day",
+        **(config or {}),
+    )
+    context = {
+        "stream_name": "test_stream",
+        "logger": logging.getLogger("target-s3"),
+        "stream_schema": stream_schema or {"properties": {}},
+        "stream_cache": {},
+        "batch_start_time": datetime(2023, 1, 2, tzinfo=timezone.utc),
+        "records": records,
+        "connection": connection,
+    }
+    ret = format_class(config, context)
+    ret.records = records
+    return ret
+
+
+def test_json_serialize_streams_one_array(monkeypatch):
+    monkeypatch.setattr(format_base, "WRITE_CHUNK_SIZE", 2)
+    records = [{"id": i, "amount": Decimal("1.10")} for i in range(5)]
+
+    config = {
+        "format": {"format_type": "json", "format_json": {"encoder": "simplejson"}}
+    }
+
+    text = b"".join(format_client(FormatJson, records, config).serialize())
+
+    assert text.decode() == dumps(records, cls=JsonSerialize, use_decimal=True)
+
+
+def test_jsonl_serialize_streams_lines(monkeypatch):
+    monkeypatch.setattr(format_base, "WRITE_CHUNK_SIZE", 2)
+    records = [{"id": i} for i in range(5)]
+
+    config = {
+        "format": {"format_type": "jsonl", "format_jsonl": {"encoder": "simplejson"}}
+    }
+
+    text = b"".join(format_client(FormatJsonl, records, config).serialize())
+
+    assert text.decode() == "\n".join(map(dumps, records))
+
+
+@pytest.mark.parametrize("encoder", ["auto", "simplejson", "orjson", "msgspec"])
+def test_encoders_write_integers_beyond_64_bits(encoder):
+    record = {"big": 123456789012345678901234567890, "at": datetime(2023, 1, 2)}
+
+    ret = get_encoder(encoder)(record)
+
+    assert loads(ret) == {
+        "big": 123456789012345678901234567890,
+        "at": "2023-01-02T00:00:00",
+    }
+
+
+@pytest.mark.parametrize("encoder", ["simplejson", "msgspec"])
+def test_jsonl_splices_batch_metadata(encoder):
+    records = [{"id": 1}, {}]
+    config = {
+        "format": {"format_type": "jsonl", "format_jsonl": {"encoder": encoder}},
+        "include_stream_name": True,
+        "include_sdc_batch_metadata": True,
+    }
+    text = b"".join(format_client(FormatJsonl, records, config).serialize())
+
+    metadata = {
+        "_STREAM_NAME": "test_stream",
+        "_sdc_batched_at": "2023-01-02T00:00:00+00:00",
+        # not in the test context
+        "_sdc_sync_started_at": None,
+    }
+    assert [loads(line) for line in text.splitlines()] == [
+        {"id": 1, **metadata},
+        metadata,
+    ]
+    # the records are left as they were
+    assert records == [{"id": 1}, {}]
+
+
+@pytest.mark.parametrize("encoder", ["simplejson", "msgspec"])
+def test_jsonl_keeps_metadata_columns_of_the_records(encoder):
+    # the schema doesn't declare _STREAM_NAME, one record has it anyway
+    records = [{"id": 1, "_STREAM_NAME": "own"}, {"id": 2}]
+    config = {
+        "format": {"format_type": "jsonl", "format_jsonl": {"encoder": encoder}},
+        "include_stream_name": True,
+    }
+    text = b"".join(format_client(FormatJsonl, records, config).serialize())
+
+    lines = text.decode().splitlines()
+    assert lines[0].count("_STREAM_NAME") == 1
+    assert [loads(line) for line in lines] == [
+        {"id": 1, "_STREAM_NAME": "own"},
+        {"id": 2, "_STREAM_NAME": "test_stream"},
+    ]
+
+
+@pytest.mark.parametrize("encoder", ["simplejson", "orjson", "msgspec"])
+def test_encoders_agree_on_special_types(encoder):
+    try:
+        encode = get_encoder(encoder)
+    except ImportError:
+        pytest.skip(f"{encoder} is not installed")
+    record = {
+        "_id": ObjectId("64b7f0f0f0f0f0f0f0f0f0f0"),
+        "amount": Decimal("10.000000000000000001"),
+        "updated_at": datetime(2023, 1, 2, 3, 4, 5, tzinfo=timezone.utc),
+    }
+
+    ret = loads(encode(record), use_decimal=True)
+
+    assert ret["_id"] == "64b7f0f0f0f0f0f0f0f0f0f0"
+    assert ret["amount"] == Decimal("10.000000000000000001")
+    assert datetime.fromisoformat(ret["updated_at"].replace("Z", "+00:00")) == (
+        record["updated_at"]
+    )
+
+
+def test_csv_serialize_orders_columns_by_schema(monkeypatch):
+    monkeypatch.setattr(format_base, "WRITE_CHUNK_SIZE", 2)
+    stream_schema = {"properties": {"id": {}, "name": {}, "missing": {}}}
+    records = [
+        {"name": "a", "id": 1},
+        {"id": 2, "tags": ["x"], "extra": "b|c"},
+        {"id": 3, "name": "c", "tags": {"k": 1}},
+    ]
+
+    config = {"format": {"format_type": "csv", "format_csv": {"delimiter": "|"}}}
+
+    text = b"".join(
+        format_client(FormatCsv, records, config, stream_schema).serialize()
+    )
+
+    assert text.decode().splitlines() == [
+        '"id"|"name"|"missing"|"tags"|"extra"',
+        '1|"a"|||',
+        '2|||"[""x""]"|"b|c"',
+        '3|"c"||"{""k"":1}"|',
+    ]
+
+
+def test_csv_convert_column_falls_back_to_strings():
+    config = {"format": {"format_type": "csv", "format_csv": {"nested_values": "null"}}}
+    client = format_client(FormatCsv, [], config)
+
+    ret = client.convert_column([1, "a", {"k": 1}, None, "\ud83d\ude00"])
+
+    assert ret.to_pylist() == ["1", "a", None, None, "\U0001f600"]
+
+
+def test_csv_convert_column_writes_big_integers_as_strings():
+    client = format_client(FormatCsv, [])
+
+    ret = client.convert_column([1, 123456789012345678901234567890, None])
+
+    assert ret.to_pylist() == ["1", "123456789012345678901234567890", None]
+
+
+def test_write_partitions_splits_records_by_field(monkeypatch):
+    records = [
+        {"id": 1, "kind": "a", "at": datetime(2023, 1, 1, 5, tzinfo=timezone.utc)},
+        {"id": 2, "kind": "b", "at": datetime(2023, 1, 2, 6, tzinfo=timezone.utc)},
+        {"id": 3, "kind": "a", "at": datetime(2023, 1, 1, 7, tzinfo=timezone.utc)},
+    ]
+    config = {
+        "format": {"format_type": "jsonl"},
+        "partition_by": [{"field": "at", "name": "event_date", "grain": "day"}],
+    }
+    client = format_client(FormatJsonl, records, config)
+    key = client.fully_qualified_key
+    written = {}
+    monkeypatch.setattr(
+        client,
+        "_write",
+        lambda: written.update({client.fully_qualified_key: client.records}),
+    )
+
+    client._write_partitions()
+
+    folder, _, file_name = key.rpartition("/")
+    assert written == {
+        f"{folder}/event_date=2023-01-01/{file_name}": [records[0], records[2]],
+        f"{folder}/event_date=2023-01-02/{file_name}": [records[1]],
+    }
+    assert client.fully_qualified_key == key
+
+
+def test_partition_paths_escapes_and_truncates():
+    columns = {"kind": ["a/b", None, 1], "at": ["2023-01-02T03:04:05Z"] * 3}
+    partition_by = [{"field": "kind"}, {"field": "at", "grain": "month"}]
+
+    ret = partition_paths(columns, partition_by)
+
+    assert ret.to_pylist() == [
+        "kind=a%2Fb/at=2023-01",
+        "kind=__HIVE_DEFAULT_PARTITION__/at=2023-01",
+        "kind=1/at=2023-01",
+    ]
+
+
+def test_create_key_appends_batch_id():
+    client = format_client(FormatJsonl, [], {"format": {"format_type": "jsonl"}})
+    client.context["batch_id"] = "b1"
+    unique = client.create_key()
+    client.config["append_batch_id_to_filename"] = False
+    plain = client.create_key()
+
+    assert unique == plain.replace("20230102.", "20230102-b1.")
+
+
+@pytest.mark.parametrize(
+    "codec, extension",
+    [
+        ("none", "jsonl"),
+        ("gzip", "jsonl.gz"),
+        ("zstd", "jsonl.zst"),
+        ("bz2", "jsonl.bz2"),
+    ],
+)
+def test_compression_round_trips_and_names_the_key(codec, extension):
+    config = {
+        "format": {"format_type": "jsonl", "format_jsonl": {"compression": codec}}
+    }
+    client = format_client(FormatJsonl, [], config)
+    buffer = io.BytesIO()
+
+    with open_compressor(buffer, codec, 1) as f:
+        f.write(b'{"id": 1}')
+    buffer.seek(0)
+    with open_decompressor(buffer, codec) as f:
+        text = f.read()
+
+    assert text == b'{"id": 1}'
+    assert client.fully_qualified_key.endswith(f"/20230102.{extension}")
+
+
+def test_compression_level_needs_a_codec_with_levels():
+    config = {
+        "format": {
+            "format_type": "jsonl",
+            "format_jsonl": {"compression": "none", "compression_level": 1},
+        }
+    }
+
+    with pytest.raises(AssertionError, match="compression_level"):
+        format_client(FormatJsonl, [], config)
@@ -0,0 +1,323 @@
+"""Tests the compact command."""
+
+from __future__ import annotations
+
+import gzip
+import io
+import json
+import random
+
+import boto3
+import pyarrow
+import pytest
+from click.testing import CliRunner
+from moto.server import ThreadedMotoServer
+from pyarrow import parquet as pq
+
+from target_s3.compact import Compactor, cli, find_small_objects, jsonl_codec
+from target_s3.tests.test_upload import RecordingClient
+
+
+class FakeClient:
+    def __init__(self, objects: dict) -> None:
+        self.objects = objects
+
+    def get_paginator(self, name: str):
+        return self
+
+    def paginate(self, Bucket: str, Prefix: str):
+        yield {
+            "Contents": [
+                {"Key": k, "Size": v}
+                for k, v in self.objects.items()
+                if k.startswith(Prefix)
+            ]
+        }
+
+
+def test_find_small_objects_groups_by_folder_and_extension():
+    client = FakeClient(
+        {
+            "p/s/day=1/a.jsonl.gz": 10,
+            "p/s/day=1/b.jsonl.gz": 10,
+            "p/s/day=1/c.jsonl": 10,
+            "p/s/day=1/big.jsonl.gz": 100,
+            "p/s/day=2/a.gz.parquet": 10,
+            "p/s/day=2/b.gz.parquet": 10,
+            "p/s/day=2/a.json.gz": 10,
+            "p/s/day=2/b.json.gz": 10,
+            "p/s/day=3/a.gz.parquet": 10,
+        }
+    )
+
+    ret = find_small_objects(client, "bucket", "p/s/", 100)
+
+    assert ret == {
+        ("p/s/day=1", "jsonl.gz"): [
+            ("p/s/day=1/a.jsonl.gz", 10),
+            ("p/s/day=1/b.jsonl.gz", 10),
+        ],
+        ("p/s/day=2", "gz.parquet"): [
+            ("p/s/day=2/a.gz.parquet", 10),
+            ("p/s/day=2/b.gz.parquet", 10),
+        ],
+    }
+    assert jsonl_codec("jsonl.zst") == "zstd"
+    assert jsonl_codec("json.gz") is False
+
+
+@pytest.fixture(scope="module")
+def endpoint():
+    # pyarrow's S3FileSystem reads the parquet sources, so moto runs as a server
+    server = ThreadedMotoServer(port=0, verbose=False)
+    server.start()
+    yield f"http://127.0.0.1:{server._server.server_port}"
+    server.stop()
+
+
+@pytest.fixture
+def s3(endpoint):
+    client = boto3.client(
+        "s3",
+        endpoint_url=endpoint,
+        aws_access_key_id="testing",
+        aws_secret_access_key="testing",
+        region_name="us-east-1",
+    )
+    client.create_bucket(Bucket="bucket")
+    yield client
+    for obj in client.list_objects_v2(Bucket="bucket").get("Contents", []):
+        client.delete_object(Bucket="bucket", Key=obj["Key"])
+    client.delete_bucket(Bucket="bucket")
+
+
+@pytest.fixture
+def config(endpoint):
+    return {
+        "cloud_provider": {
+            "cloud_provider_type": "aws",
+            "aws": {
+                "aws_access_key_id": "testing",
+                "aws_secret_access_key": "testing",
+                "aws_bucket": "bucket",
+                "aws_region": "us-east-1",
+                "aws_endpoint_override": endpoint,
+            },
+        },
+        "format": {"format_type": "parquet", "format_parquet": {"compression": "gzip"}},
+    }
+
+
+def keys(s3) -> list:
+    return sorted(o["Key"] for o in s3.list_objects_v2(Bucket="bucket")["Contents"])
+
+
+def put_parquet(s3, key: str, ids: list) -> None:
+    buffer = io.BytesIO()
+    pq.write_table(pyarrow.table({"id": ids}), buffer, compression="snappy")
+    s3.put_object(Bucket="bucket", Key=key, Body=buffer.getvalue())
+
+
+def read_parquet(s3, key: str) -> pyarrow.Table:
+    body = s3.get_object(Bucket="bucket", Key=key)["Body"].read()
+    return pq.read_table(io.BytesIO(body))
+
+
+def put_jsonl(s3, key: str, ids: list, **columns) -> None:
+    records = [
+        dict({"id": i}, **{k: v[n] for k, v in columns.items()})
+        for n, i in enumerate(ids)
+    ]
+    # the target doesn't end objects with a newline
+    body = "\n".join(json.dumps(r) for r in records).encode()
+    s3.put_object(Bucket="bucket", Key=key, Body=gzip.compress(body))
+
+
+def read_jsonl(s3, key: str) -> list:
+    body = s3.get_object(Bucket="bucket", Key=key)["Body"].read()
+    return [json.loads(line) for line in gzip.decompress(body).splitlines()]
+
+
+def test_compact_merges_parquet_with_the_configured_codec(s3, config):
+    for n in range(3):
+        put_parquet(s3, f"p/s/day=1/{n}.snappy.parquet", [2 * n, 2 * n + 1])
+
+    ret = Compactor(config).compact("p/s/")
+
+    [output] = ret[0]["outputs"]
+    assert output.startswith("p/s/day=1/compacted-")
+    assert output.endswith(".gz.parquet")
+    assert keys(s3) == [output]
+    table = read_parquet(s3, output)
+    assert table.column("id").to_pylist() == [0, 1, 2, 3, 4, 5]
+    assert (
+        pq.ParquetFile(
+            io.BytesIO(s3.get_object(Bucket="bucket", Key=output)["Body"].read())
+        )
+        .metadata.row_group(0)
+        .column(0)
+        .compression
+        == "GZIP"
+    )
+
+
+def test_compact_merges_jsonl_lines(s3, config):
+    for n in range(3):
+        put_jsonl(s3, f"p/s/{n}.jsonl.gz", [2 * n, 2 * n + 1])
+
+    ret = Compactor(config).compact("p/s/")
+
+    [output] = ret[0]["outputs"]
+    assert output.endswith(".jsonl.gz")
+    assert keys(s3) == [output]
+    assert read_jsonl(s3, output) == [{"id": i} for i in range(6)]
+
+
+def test_compact_rolls_outputs_at_max_bytes(s3, config):
+    for n in range(4):
+        ids = list(range(1000 * n, 1000 * n + 1000))
+        # random values, so the data and not the footers or the compressor's
+        # buffer make up the size
+        rng = random.Random(n)
+        x = [rng.random() for _ in ids]
+        table = pyarrow.table({"id": ids, "x": x})
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression="gzip")
+        s3.put_object(
+            Bucket="bucket", Key=f"p/pq/{n}.gz.parquet", Body=buffer.getvalue()
+        )
+        put_jsonl(s3, f"p/js/{n}.jsonl.gz", ids, x=x)
+    sizes = {
+        o["Key"]: o["Size"] for o in s3.list_objects_v2(Bucket="bucket")["Contents"]
+    }
+
+    # an output is rolled once past the limit, after two sources
+    parquet_outputs = Compactor(config, int(sizes["p/pq/0.gz.parquet"] * 1.5)).compact(
+        "p/pq/"
+    )[0]["outputs"]
+    jsonl_outputs = Compactor(config, int(sizes["p/js/0.jsonl.gz"] * 1.5)).compact(
+        "p/js/"
+    )[0]["outputs"]
+
+    assert len(parquet_outputs) == 2
+    assert len(jsonl_outputs) == 2
+    assert keys(s3) == sorted(parquet_outputs + jsonl_outputs)
+    assert sorted(
+        i for key in parquet_outputs for i in read_parquet(s3, key)["id"].to_pylist()
+    ) == list(range(4000))
+    assert sorted(
+        r["id"] for key in jsonl_outputs for r in read_jsonl(s3, key)
+    ) == list(range(4000))
+
+
+@pytest.mark.parametrize("extension", ["gz.parquet", "jsonl.gz"])
+def test_compact_keeps_the_sources_when_a_write_fails(s3, config, extension):
+    put = put_parquet if extension.endswith("parquet") else put_jsonl
+    sources = [f"p/s/{n}.{extension}" for n in range(3)]
+    for n, key in enumerate(sources):
+        put(s3, key, [n])
+    compactor = Compactor(config)
+    compactor.client = RecordingClient(compactor.client, fail="put_object")
+
+    with pytest.raises(ConnectionError):
+        compactor.compact("p/s/")
+
+    # no source is deleted and nothing merged is left behind
+    assert keys(s3) == sources
+
+
+def test_compact_dry_run_deletes_nothing(s3, config, tmp_path):
+    sources = [f"p/s/{n}.jsonl.gz" for n in range(2)]
+    for n, key in enumerate(sources):
+        put_jsonl(s3, key, [n])
+    config_file = tmp_path / "config.json"
+    config_file.write_text(json.dumps(config))
+
+    ret = CliRunner().invoke(
+        cli, ["--config", str(config_file), "--prefix", "p/s/", "--dry-run"]
+    )
+
+    assert ret.exit_code == 0, ret.output
+    assert json.loads(ret.stdout) == [{"sources": sources, "outputs": []}]
+    assert keys(s3) == sources
+
+
+def put_manifest(s3, key: str, started_at: str, objects: list) -> None:
+    document = {
+        "stream": "s",
+        "run_id": key.rpartition("/")[2][: -len(".json")],
+        "started_at": started_at,
+        "updated_at": started_at,
+        "objects": objects,
+    }
+    s3.put_object(Bucket="bucket", Key=key, Body=json.dumps(document).encode())
+
+
+def read_manifest(s3, key: str) -> dict:
+    return json.loads(s3.get_object(Bucket="bucket", Key=key)["Body"].read())
+
+
+def entry(key: str, low: int, high: int) -> dict:
+    return {
+        "key": key,
+        "rows": high - low + 1,
+        "bytes": 1,
+        "partition": {"day": "1"},
+        "columns": {"id": {"min": low, "max": high}},
+    }
+
+
+@pytest.mark.parametrize("extension", ["gz.parquet", "jsonl.gz"])
+def test_compact_rewrites_the_manifests(s3, config, extension):
+    put = put_parquet if extension.endswith("parquet") else put_jsonl
+    sources = [f"p/s/day=1/{n}.{extension}" for n in range(3)]
+    for n, key in enumerate(sources):
+        put(s3, key, [2 * n, 2 * n + 1])
+    put_manifest(
+        s3,
+        "p/s/_manifests/a.json",
+        "2024-01-01T00:00:00+00:00",
+        [entry(sources[0], 0, 1), entry(sources[1], 2, 3), entry("p/s/other", 9, 9)],
+    )
+    put_manifest(
+        s3,
+        "p/s/_manifests/b.json",
+        "2024-01-02T00:00:00+00:00",
+        [entry(sources[2], 4, 5)],
+    )
+
+    [output] = Compactor(config).compact("p/s/day=1/")[0]["outputs"]
+
+    first = read_manifest(s3, "p/s/_manifests/a.json")
+    latest = read_manifest(s3, "p/s/_manifests/b.json")
+    # deleted keys are dropped, the merged object goes to the latest manifest
+    assert [e["key"] for e in first["objects"]] == ["p/s/other"]
+    [merged] = latest["objects"]
+    size = s3.head_object(Bucket="bucket", Key=output)["ContentLength"]
+    assert merged == {
+        "key": output,
+        "rows": 6,
+        "bytes": size,
+        "partition": {"day": "1"},
+        "columns": {"id": {"min": 0, "max": 5}},
+    }
+    assert latest["updated_at"] > "2024-01-02T00:00:00+00:00"
+
+
+def test_compact_leaves_out_stats_of_unlisted_jsonl_sources(s3, config):
+    sources = [f"p/s/{n}.jsonl.gz" for n in range(2)]
+    for n, key in enumerate(sources):
+        put_jsonl(s3, key, [n])
+    put_manifest(
+        s3,
+        "p/s/_manifests/a.json",
+        "2024-01-01T00:00:00+00:00",
+        [entry(sources[0], 0, 0)],
+    )
+
+    [output] = Compactor(config).compact("p/s/")[0]["outputs"]
+
+    [merged] = read_manifest(s3, "p/s/_manifests/a.json")["objects"]
+    assert merged["key"] == output
+    assert merged["rows"] == 2
+    assert merged["columns"] == {}
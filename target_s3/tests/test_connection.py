@@ -0,0 +1,49 @@
+"""Tests the s3 connection cache without an object store."""
+
+from __future__ import annotations
+
+from collections import namedtuple
+
+from target_s3.connection import S3Connection
+from target_s3.formats.format_jsonl import FormatJsonl
+from target_s3.tests import test_core
+from target_s3.tests.test_base import format_client
+
+Frozen = namedtuple("Frozen", ["access_key", "secret_key", "token"])
+
+
+class FakeSession:
+    region_name = "us-east-1"
+
+    def __init__(self, frozen: Frozen) -> None:
+        self.frozen = frozen
+
+    def get_credentials(self):
+        return self
+
+    def get_frozen_credentials(self) -> Frozen:
+        return self.frozen
+
+
+def test_client_is_shared_by_every_batch():
+    connection = S3Connection(test_core.SAMPLE_CONFIG)
+    config = {"format": {"format_type": "jsonl"}}
+    first = format_client(FormatJsonl, [], config, connection=connection)
+    second = format_client(FormatJsonl, [], config, connection=connection)
+
+    assert first.session is second.session is connection.session
+    assert first.client is second.client is connection.client
+
+
+def test_file_system_is_rebuilt_when_credentials_change():
+    connection = S3Connection(test_core.SAMPLE_CONFIG)
+    session = connection._session = FakeSession(Frozen("a", "b", "t1"))
+
+    first = connection.file_system
+    same = connection.file_system
+    session.frozen = Frozen("a", "b", "t2")
+    rebuilt = connection.file_system
+
+    assert same is first
+    assert rebuilt is not first
+    assert connection.file_system is rebuilt
@@ -2,10 +2,16 @@
 
 from __future__ import annotations
 
+import decimal
+import json
+import sys
 from typing import Any
 
+import pytest
 from singer_sdk.testing import get_target_test_class
 
+from target_s3 import sinks
+from target_s3.formats.json_encoder import get_encoder
 from target_s3.target import Targets3
 
 SAMPLE_CONFIG: dict[str, Any] = {
@@ -26,3 +32,113 @@ SAMPLE_CONFIG: dict[str, Any] = {
 }
 
 TestTargetS3 = get_target_test_class(Targets3, config=SAMPLE_CONFIG)
+
+
+@pytest.mark.parametrize(
+    "line",
+    [
+        '{"type": "RECORD", "record": {"id": 1, "at": "2023-01-02T03:04:05.678Z"}}',
+        '{"type": "RECORD", "record": {"amount": 1.10, "rate": [2E-3, -0.5]}}',
+        '{"type": "RECORD", "record": {"big": 123456789012345678901234567890}}',
+        '{"type": "RECORD", "record": {"note": "ratio: 1.5, ok", "n": NaN}}',
+    ],
+)
+def test_deserialize_json_matches_stdlib(line):
+    target = Targets3(config=SAMPLE_CONFIG)
+
+    ret = target.deserialize_json(line)
+
+    # repr, since NaN never compares equal
+    assert repr(ret) == repr(json.loads(line, parse_float=decimal.Decimal))
+
+
+@pytest.mark.parametrize("spool_batches", [False, True])
+def test_process_record_keeps_the_latest_version_per_key(spool_batches):
+    config = dict(
+        SAMPLE_CONFIG,
+        dedupe_batches=True,
+        dedupe_order_by="version",
+        spool_batches=spool_batches,
+    )
+    schema = {"properties": {"id": {"type": "integer"}, "version": {"type": "integer"}}}
+    sink = Targets3(config=config).add_sink("users", schema, ["id"])
+    context = {}
+
+    for record in [
+        {"id": 1, "version": 1},
+        {"id": 2, "version": 5},
+        {"id": 1, "version": 3},
+        {"id": 2, "version": 4},
+        {"id": 1, "version": 3, "last": True},
+    ]:
+        sink.process_record(record, context)
+
+    # spooled versions are appended, listed versions replace the first in place
+    assert sorted(context["records"], key=lambda r: r["id"]) == [
+        {"id": 1, "version": 3, "last": True},
+        {"id": 2, "version": 5},
+    ]
+    assert len(context["records"]) == 2
+
+
+@pytest.mark.parametrize("spool_batches", [False, True])
+def test_max_batch_bytes_fills_the_batch(spool_batches):
+    record_bytes = len(get_encoder()({"id": 1, "name": "x" * 20}))
+    config = dict(
+        SAMPLE_CONFIG,
+        max_batch_bytes=3 * record_bytes + 1,
+        dedupe_batches=True,
+        spool_batches=spool_batches,
+    )
+    schema = {"properties": {"id": {"type": "integer"}, "name": {"type": "string"}}}
+    sink = Targets3(config=config).add_sink("users", schema, ["id"])
+    context = {}
+
+    # every version of the same key replaces the size of the one before
+    for _ in range(10):
+        sink.process_record({"id": 1, "name": "x" * 20}, context)
+    assert sink.batch_bytes == record_bytes
+    sink.process_record({"id": 2, "name": "x" * 20}, context)
+    sink.process_record({"id": 3, "name": "x" * 20}, context)
+    assert not sink.is_full
+    sink.process_record({"id": 4, "name": "x" * 20}, context)
+
+    assert sink.is_full
+    assert sink.batch_bytes == 4 * record_bytes
+
+
+def test_max_batch_bytes_samples_record_sizes(monkeypatch):
+    config = dict(SAMPLE_CONFIG, max_batch_bytes=10**9)
+    sink = Targets3(config=config).add_sink("users", {"properties": {}}, [])
+    encoded = []
+    encode = sink.encode
+    monkeypatch.setattr(sink, "encode", lambda r: encoded.append(r) or encode(r))
+    context = {}
+
+    rate = sinks.SIZE_SAMPLE_RATE
+    # the first record and the rate-th are encoded
+    for i in range(2 * rate - 1):
+        sink.process_record({"name": "x" * (10 if i < rate - 1 else 30)}, context)
+
+    assert encoded == [{"name": "x" * 10}, {"name": "x" * 30}]
+    small, large = len(encode(encoded[0])), len(encode(encoded[1]))
+    average = (small + large) // 2
+    assert sink.batch_bytes == (rate - 1) * small + large + (rate - 1) * average
+
+
+def test_deserialize_json_keeps_big_integers_without_msgspec(monkeypatch):
+    # the get_schema_from_tap path, where floats aren't parsed as decimals
+    monkeypatch.setitem(sys.modules, "msgspec", None)
+    config = dict(
+        SAMPLE_CONFIG,
+        format={
+            "format_type": "parquet",
+            "format_parquet": {"get_schema_from_tap": True},
+        },
+    )
+    target = Targets3(config=config)
+
+    ret = target.deserialize_json('{"big": 123456789012345678901234567890, "f": 1.5}')
+
+    assert target._fast_loads is None
+    assert ret == {"big": 123456789012345678901234567890, "f": 1.5}
@@ -0,0 +1,82 @@
+"""Tests the per run manifest."""
+
+from __future__ import annotations
+
+import io
+import json
+from datetime import datetime, timezone
+
+import pyarrow
+from pyarrow import parquet
+
+from target_s3.manifest import ColumnStats, Manifest
+
+
+class FakeClient:
+    def __init__(self) -> None:
+        self.objects = {}
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.objects[(Bucket, Key)] = Body
+
+
+def test_column_stats_from_records_and_parquet_agree():
+    records = [
+        {"id": 2, "at": datetime(2023, 1, 2, tzinfo=timezone.utc), "tags": ["a"]},
+        {"id": 1, "name": "b", "flag": True},
+        {"id": 3, "name": "a", "mixed": 1},
+        {"id": 4, "mixed": "x"},
+    ]
+    from_records = ColumnStats()
+    from_records.add_records(records[:2])
+    from_records.add_records(records[2:])
+    # parquet can't hold the mixed column
+    columns = ("id", "at", "name", "tags", "flag")
+    table = pyarrow.Table.from_pylist([{k: r.get(k) for k in columns} for r in records])
+    buffer = io.BytesIO()
+    parquet.write_table(table, buffer, row_group_size=2)
+    from_parquet = ColumnStats()
+    from_parquet.add_parquet(parquet.ParquetFile(buffer).metadata)
+
+    assert from_records.rows == from_parquet.rows == 4
+    assert (
+        from_records.to_dict()
+        == from_parquet.to_dict()
+        == {
+            "id": {"min": 1, "max": 4},
+            "at": {
+                "min": datetime(2023, 1, 2, tzinfo=timezone.utc),
+                "max": datetime(2023, 1, 2, tzinfo=timezone.utc),
+            },
+            "name": {"min": "a", "max": "b"},
+        }
+    )
+
+
+def test_manifest_is_rewritten_with_every_object():
+    client = FakeClient()
+    key = "prefix/users/_manifests/run.json"
+    manifest = Manifest(client, "bucket", key, "users", "run")
+    stats = ColumnStats()
+    stats.add_records([{"id": 1}, {"id": 2}])
+
+    manifest.add("bucket/prefix/users/a.json", 10, stats, "year=2023/month=01")
+    manifest.add("bucket/prefix/users/b.json", 20, ColumnStats())
+
+    document = json.loads(client.objects[("bucket", key)])
+    assert document["objects"] == [
+        {
+            "key": "prefix/users/a.json",
+            "rows": 2,
+            "bytes": 10,
+            "partition": {"year": "2023", "month": "01"},
+            "columns": {"id": {"min": 1, "max": 2}},
+        },
+        {
+            "key": "prefix/users/b.json",
+            "rows": 0,
+            "bytes": 20,
+            "partition": {},
+            "columns": {},
+        },
+    ]
@@ -0,0 +1,48 @@
+"""Tests the per stream metrics."""
+
+from __future__ import annotations
+
+import json
+
+from target_s3.metrics import BatchMetrics, MetricsRegistry
+
+
+def batch(records: int, serialized_bytes: int, output_bytes: int) -> BatchMetrics:
+    ret = BatchMetrics()
+    ret.batches = 1
+    ret.records = records
+    ret.serialized_bytes = serialized_bytes
+    ret.output_bytes = output_bytes
+    ret.seconds["upload"] = 0.5
+    return ret
+
+
+def test_metrics_registry_sums_batches_per_stream(tmp_path):
+    path = tmp_path / "metrics.json"
+    registry = MetricsRegistry(str(path))
+    registry.record("users", batch(10, 400, 100))
+    registry.record("users", batch(5, 200, 100))
+    registry.record("orders", batch(1, 50, 0))
+
+    registry.flush()
+
+    streams = json.loads(path.read_text())["streams"]
+    assert streams["users"]["batches"] == 2
+    assert streams["users"]["records"] == 15
+    assert streams["users"]["compression_ratio"] == 3.0
+    assert streams["users"]["seconds"]["upload"] == 1.0
+    assert streams["orders"]["compression_ratio"] is None
+
+
+def test_metrics_registry_prometheus(tmp_path):
+    path = tmp_path / "target_s3.prom"
+    registry = MetricsRegistry(str(path), "prometheus")
+    registry.record('a"b', batch(10, 400, 100))
+
+    registry.flush()
+
+    lines = path.read_text().splitlines()
+    assert "# TYPE target_s3_records_total counter" in lines
+    assert 'target_s3_records_total{stream="a\\"b"} 10' in lines
+    assert 'target_s3_compression_ratio{stream="a\\"b"} 4.0' in lines
+    assert 'target_s3_seconds_total{stream="a\\"b",stage="upload"} 0.5' in lines
@@ -0,0 +1,345 @@
+"""Tests the parquet format without an object store."""
+
+from __future__ import annotations
+
+import concurrent.futures
+import io
+import logging
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pyarrow
+import pytest
+from pyarrow import ipc
+from pyarrow import parquet as pq
+from singer_sdk.target_base import Target
+
+from target_s3.formats.format_parquet import (
+    FormatParquet,
+    ParquetStreamWriter,
+    convert_in_worker,
+    writer_options,
+)
+from target_s3.formats.json_encoder import get_encoder
+from target_s3.target import Targets3
+from target_s3.tests import test_core
+
+
+def format_parquet(
+    records: list,
+    format_parquet: dict = None,
+    stream_schema: dict = None,
+    stream_cache: dict = None,
+    config: dict = None,
+):
+    config = dict(
+        test_core.SAMPLE_CONFIG,
+        format={"format_type": "parquet", "format_parquet": format_parquet or {}},
+        append_date_to_prefix=True,
+        append_date_to_prefix_grain="day",
+        partition_name_enabled=False,
+        append_date_to_filename=True,
+        append_date_to_filename_grain="day",
+        **(config or {}),
+    )
+    context = {
+        "stream_name": "test_stream",
+        "logger": logging.getLogger("target-s3"),
+        "stream_schema": stream_schema or {"properties": {}},
+        "stream_cache": {} if stream_cache is None else stream_cache,
+        "batch_start_time": datetime(2023, 1, 2, tzinfo=timezone.utc),
+        "records": records,
+    }
+    ret = FormatParquet(config, context)
+    ret.records = records
+    return ret
+
+
+def test_create_dataframe_unions_keys():
+    records = [{"id": 1, "empty": {}}, {"id": 2, "name": "b", "empty": {}}]
+    df = format_parquet(records).create_dataframe()
+
+    assert df.column_names == ["id", "empty", "name"]
+    assert df.schema.field("empty").type == pyarrow.null()
+    assert df.column("name").to_pylist() == [None, "b"]
+
+
+@pytest.mark.parametrize("tap_schema", [False, True])
+def test_create_dataframe_writes_empty_objects_as_null(tap_schema):
+    records = [
+        {"id": 1, "meta": {"a": 1}},
+        {"id": 2, "meta": {}},
+        {"id": 3, "meta": None},
+        {"id": 4, "meta": {}},
+    ]
+    stream_schema = {
+        "properties": {
+            "id": {"type": "integer"},
+            "meta": {
+                "type": ["object", "null"],
+                "properties": {"a": {"type": ["integer", "null"]}},
+            },
+        }
+    }
+    if tap_schema:
+        parquet = format_parquet(records, {"get_schema_from_tap": True}, stream_schema)
+    else:
+        parquet = format_parquet(records)
+
+    df = parquet.create_dataframe()
+
+    assert df.column("meta").to_pylist() == [{"a": 1}, None, None, None]
+
+
+def test_create_dataframe_sanitizes_failing_columns_only():
+    records = [
+        {"id": 1, "name": "a\ud800"},
+        {"id": 2, "name": "b"},
+        {"id": 3, "name": "\ud83d\ude00"},
+    ]
+    parquet = format_parquet(records)
+    df = parquet.create_dataframe()
+
+    assert df.column("id").to_pylist() == [1, 2, 3]
+    assert df.column("name").to_pylist() == ['"a\\ud800"', "b", "\U0001f600"]
+    assert parquet.repaired_strings == 2
+
+
+def test_create_dataframe_from_tap_schema():
+    stream_schema = {
+        "properties": {
+            "id": {"type": "integer"},
+            "tags": {"type": ["array", "null"], "items": {"type": "string"}},
+        }
+    }
+    records = [{"id": 1, "tags": ["a"], "ignored": True}, {"id": 2}]
+    df = format_parquet(
+        records, {"get_schema_from_tap": True}, stream_schema
+    ).create_dataframe()
+
+    assert df.schema.names == ["id", "tags"]
+    assert df.column("tags").to_pylist() == [["a"], None]
+
+
+def test_compile_schema_is_cached_per_stream_schema():
+    stream_cache = {}
+    stream_schema = {"properties": {"id": {"type": "integer"}}}
+    first = format_parquet([], {}, stream_schema, stream_cache).compile_schema()
+    second = format_parquet([], {}, stream_schema, stream_cache).compile_schema()
+    changed = format_parquet(
+        [], {}, {"properties": {"id": {"type": "string"}}}, stream_cache
+    ).compile_schema()
+
+    assert second is first
+    assert changed is not first
+    assert len(stream_cache["parquet_schemas"]) == 2
+
+
+def test_convert_in_worker_matches_create_dataframe():
+    stream_schema = {
+        "properties": {
+            "id": {"type": "integer"},
+            "at": {"type": ["string", "null"], "format": "date-time"},
+        }
+    }
+    records = [
+        {"id": 1, "at": datetime(2023, 1, 2, tzinfo=timezone.utc), "n": Decimal("1.5")},
+        {"id": 2, "at": None, "nested": {"a": "\U0001f600"}},
+    ]
+    parquet = format_parquet(records, {}, stream_schema)
+    data = parquet.codec(get_encoder(), True).dumps(records)
+
+    ret = convert_in_worker(dict(parquet.config), stream_schema, data, True)
+
+    assert ipc.open_stream(ret).read_all().equals(parquet.create_dataframe())
+
+
+def test_build_table_ships_integers_beyond_64_bits(monkeypatch):
+    records = [{"id": 1, "big": 123456789012345678901234567890}]
+    parquet = format_parquet(records)
+    shipped = []
+
+    class Pool:
+        def submit(self, fn, config, stream_schema, data, parse_decimals):
+            shipped.extend(parquet.codec(None, parse_decimals).decode_all(data))
+            return concurrent.futures.ThreadPoolExecutor(1).submit(
+                fn, config, stream_schema, data, parse_decimals
+            )
+
+    parquet.context["process_pool"] = Pool()
+
+    # arrow can't store it either way, but the records reach the worker intact
+    with pytest.raises(OverflowError):
+        parquet.build_table()
+    assert shipped == records
+
+
+def test_sort_by_skips_missing_columns():
+    records = [{"id": 3, "g": "b"}, {"id": 1, "g": None}, {"id": 2, "g": "a"}]
+    parquet = format_parquet(records, {"sort_by": ["g", "missing", "id"]})
+
+    df = parquet.sort(parquet.create_dataframe())
+
+    assert df.column("id").to_pylist() == [2, 3, 1]
+
+
+def test_writer_options_prefers_dictionary_columns():
+    options = writer_options(
+        {"use_dictionary": False, "dictionary_columns": ["g"], "version": "2.4"}
+    )
+
+    assert options == {"use_dictionary": ["g"], "version": "2.4"}
+
+
+def test_add_metadata_slices_one_array_per_batch():
+    records = [{"id": 1}, {"id": 2}, {"id": 3}]
+    parquet = format_parquet(
+        records,
+        {"get_schema_from_tap": True},
+        {"properties": {"id": {"type": "integer"}}},
+        config={"include_process_date": True, "include_stream_name": True},
+    )
+    df = parquet.create_dataframe()
+
+    ret = parquet.add_metadata(df)
+    part = parquet.add_metadata(df.slice(1))
+
+    assert ret.column_names == ["id", "_PROCESS_DATE", "_STREAM_NAME"]
+    assert ret.schema.field("_PROCESS_DATE").type == pyarrow.timestamp("s", tz="utc")
+    assert len(set(ret.column("_PROCESS_DATE").to_pylist())) == 1
+    assert part.column("_STREAM_NAME").to_pylist() == ["test_stream"] * 2
+    # the second table reuses the array built for the first
+    assert len(parquet.metadata_arrays["_STREAM_NAME"]) == 3
+    assert records == [{"id": 1}, {"id": 2}, {"id": 3}]
+
+
+class MemoryOutput(io.BytesIO):
+    """An output file kept in memory, readable once closed."""
+
+    busy_seconds = 0.0
+
+    def close(self) -> None:
+        self.data = self.getvalue()
+        super().close()
+
+    def tell(self) -> int:
+        return len(self.data) if self.closed else super().tell()
+
+
+def stream_writer(**kwargs):
+    outputs = {}
+
+    def open_output(path: str) -> MemoryOutput:
+        outputs[path] = MemoryOutput()
+        return outputs[path]
+
+    return (
+        ParquetStreamWriter(logging.getLogger("target-s3"), **kwargs),
+        outputs,
+        open_output,
+    )
+
+
+def test_stream_writer_rolls_files_by_rows_bytes_and_schema():
+    table = pyarrow.table({"id": [1, 2]})
+
+    writer, outputs, open_output = stream_writer(max_file_rows=4)
+    for _ in range(3):
+        writer.write("b/s/f.parquet", table, open_output)
+    writer.close()
+    assert {
+        k: pq.read_table(io.BytesIO(o.data)).num_rows for k, o in outputs.items()
+    } == {
+        "b/s/f.parquet": 4,
+        "b/s/f-1.parquet": 2,
+    }
+
+    writer, outputs, open_output = stream_writer(max_file_bytes=1)
+    writer.write("b/s/f.parquet", table, open_output)
+    writer.write("b/s/f.parquet", table, open_output)
+    assert writer.writer is None
+    assert sorted(outputs) == ["b/s/f-1.parquet", "b/s/f.parquet"]
+
+    writer, outputs, open_output = stream_writer()
+    writer.write("b/s/f.parquet", table, open_output)
+    writer.write("b/s/f.parquet", pyarrow.table({"id": ["a"]}), open_output)
+    writer.close()
+    assert [
+        pq.read_schema(io.BytesIO(o.data)).field("id").type for o in outputs.values()
+    ] == [
+        pyarrow.int64(),
+        pyarrow.string(),
+    ]
+
+
+def test_partition_files_beyond_max_open_files_are_closed(monkeypatch):
+    stream_cache = {}
+    outputs = {}
+
+    def open_output(path: str) -> MemoryOutput:
+        outputs[path] = MemoryOutput()
+        return outputs[path]
+
+    def write(partition: str) -> None:
+        parquet = format_parquet([], {"max_open_files": 2}, stream_cache=stream_cache)
+        monkeypatch.setattr(parquet, "open_output", open_output)
+        parquet._write(
+            pyarrow.table({"id": [1]}), f"b/{partition}/f.parquet", partition
+        )
+
+    write("d=1")
+    write("d=2")
+    write("d=1")
+    write("d=3")
+
+    writers = stream_cache["parquet_writers"]
+    # d=2 was written to least recently
+    assert {p: w.is_open for p, w in writers.items()} == {
+        "d=2": False,
+        "d=1": True,
+        "d=3": True,
+    }
+    assert outputs["b/d=2/f.parquet"].closed
+    write("d=2")
+    assert not writers["d=1"].is_open
+    # the closed partition starts a new file next to its first one
+    assert sorted(outputs) == [
+        "b/d=1/f.parquet",
+        "b/d=2/f-1.parquet",
+        "b/d=2/f.parquet",
+        "b/d=3/f.parquet",
+    ]
+
+
+def test_state_message_closes_open_parquet_files(monkeypatch):
+    target = Targets3(config=test_core.SAMPLE_CONFIG)
+    writer, outputs, open_output = stream_writer()
+    writer.write("b/s/f.parquet", pyarrow.table({"id": [1]}), open_output)
+    events = []
+
+    class Sink:
+        def finalize(self):
+            FormatParquet.finalize({"parquet_writers": {"": writer}})
+            events.append("finalize")
+
+    target._sinks_to_finalize.append(Sink())
+    monkeypatch.setattr(
+        Target, "_write_state_message", lambda self, state: events.append("state")
+    )
+
+    target._write_state_message({})
+
+    assert events == ["finalize", "state"]
+    assert outputs["b/s/f.parquet"].closed
+
+
+def test_parquet_key_and_compression_level():
+    assert format_parquet([], {"compression": "snappy"}).fully_qualified_key.endswith(
+        "/20230102.snappy.parquet"
+    )
+    assert format_parquet([], {"compression": "none"}).fully_qualified_key.endswith(
+        "/20230102.parquet"
+    )
+    assert format_parquet([], {"compression": "zstd", "compression_level": 9})
+    with pytest.raises(AssertionError, match="compression_level"):
+        format_parquet([], {"compression": "snappy", "compression_level": 1})
@@ -0,0 +1,44 @@
+"""Tests unifying the schemas of the batches of a stream."""
+
+from __future__ import annotations
+
+import pyarrow
+
+from target_s3.formats.schema_evolution import SchemaRegistry, unify_types
+
+
+def test_unify_types():
+    assert unify_types(pyarrow.int32(), pyarrow.int64()) == pyarrow.int64()
+    assert unify_types(pyarrow.int64(), pyarrow.float64()) == pyarrow.float64()
+    assert unify_types(pyarrow.null(), pyarrow.bool_()) == pyarrow.bool_()
+    assert unify_types(
+        pyarrow.decimal128(5, 2), pyarrow.decimal128(6, 4)
+    ) == pyarrow.decimal128(7, 4)
+    assert unify_types(
+        pyarrow.timestamp("s", "UTC"), pyarrow.timestamp("us", "UTC")
+    ) == pyarrow.timestamp("us", "UTC")
+    assert unify_types(pyarrow.int64(), pyarrow.string()) == pyarrow.string()
+
+
+def test_schema_registry_casts_batches_to_the_unified_schema():
+    registry = SchemaRegistry()
+    registry.unify(pyarrow.table({"id": [1], "s": [{"a": 1}], "x": [1]}))
+
+    ret = registry.unify(
+        pyarrow.table(
+            {
+                "id": [1.5, None],
+                "s": [{"a": 2.5, "b": "q"}, None],
+                "x": [{"k": 1}, None],
+            }
+        )
+    )
+    # a later batch missing columns gets nulls, sliced arrays keep their rows
+    older = pyarrow.table({"id": [1, 2], "s": [{"a": 1}, {"a": 2}]}).slice(1)
+    again = registry.unify(older)
+
+    assert ret.schema.names == ["id", "s", "x"]
+    assert ret.to_pylist()[0] == {"id": 1.5, "s": {"a": 2.5, "b": "q"}, "x": '{"k": 1}'}
+    assert again.schema == ret.schema
+    assert again.to_pylist() == [{"id": 2.0, "s": {"a": 2.0, "b": None}, "x": None}]
+    assert registry.unify(again) is again
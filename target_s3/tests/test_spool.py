@@ -0,0 +1,51 @@
+"""Tests spooling batches to a temp file."""
+
+from __future__ import annotations
+
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import pytest
+
+from target_s3.formats.json_encoder import get_encoder
+from target_s3.spool import SpooledRecords
+
+
+@pytest.mark.parametrize("compression", [None, "gzip"])
+def test_spooled_records_round_trip(compression):
+    schema = {
+        "properties": {
+            "id": {"type": "integer"},
+            "at": {"type": ["string", "null"], "format": "date-time"},
+            "amount": {"type": "number"},
+        }
+    }
+    records = [
+        {
+            "id": i,
+            "at": datetime(2023, 1, 2, 3, i, tzinfo=timezone.utc),
+            "amount": Decimal("10.000000000000000001"),
+        }
+        for i in range(5)
+    ]
+    spool = SpooledRecords(get_encoder(), schema, compression=compression)
+    for record in records:
+        spool.append(record)
+
+    chunks = list(spool.chunks(2))
+
+    assert len(spool) == 5
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert sum(chunks, []) == records
+    assert list(spool) == records
+    spool.close()
+
+
+def test_spooled_records_keep_integers_beyond_64_bits():
+    records = [{"id": 1, "big": 123456789012345678901234567890}, {"id": 2, "big": -1}]
+    spool = SpooledRecords(get_encoder("auto"), {"properties": {}})
+    for record in records:
+        spool.append(record)
+
+    assert list(spool) == records
+    spool.close()
@@ -0,0 +1,25 @@
+"""Tests the target starts without importing the formats' dependencies."""
+
+from __future__ import annotations
+
+import subprocess
+import sys
+
+
+def test_cli_import_loads_formats_on_demand():
+    script = (
+        "import sys\n"
+        "from target_s3.target import Targets3\n"
+        "print(' '.join(sorted({m.partition('.')[0] for m in sys.modules})))\n"
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", script], capture_output=True, text=True, check=True
+    ).stdout.split()
+    for module in ["pyarrow", "boto3", "botocore", "bson"]:
+        assert module not in loaded
+
+    from target_s3.formats.format_parquet import FormatParquet
+    from target_s3.sinks import FORMAT_TYPE, format_class
+
+    assert set(FORMAT_TYPE) == {"parquet", "csv", "json", "jsonl"}
+    assert format_class("parquet") is FormatParquet
@@ -0,0 +1,148 @@
+"""Tests the upload pool and the multipart writer."""
+
+from __future__ import annotations
+
+import threading
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from target_s3.target import Targets3
+from target_s3.tests import test_core
+from target_s3.upload import MIN_MULTIPART_PART_SIZE, MultipartWriter, UploadPool
+
+MIB = 1024 * 1024
+
+
+class RecordingClient:
+    """Passes calls to an s3 client, recording them with the size of any body."""
+
+    def __init__(self, client, fail: str = None) -> None:
+        self.client = client
+        self.fail = fail
+        self.calls = []
+
+    def __getattr__(self, name: str):
+        method = getattr(self.client, name)
+
+        def call(*args, **kwargs):
+            self.calls.append((name, len(kwargs.get("Body", b""))))
+            if name == self.fail:
+                raise ConnectionError(f"{name} failed")
+            return method(*args, **kwargs)
+
+        return call
+
+
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        client = boto3.client("s3", region_name="us-east-1")
+        client.create_bucket(Bucket="bucket")
+        yield client
+
+
+def read(s3, key: str) -> bytes:
+    return s3.get_object(Bucket="bucket", Key=key)["Body"].read()
+
+
+def test_upload_pool_blocks_submit_while_the_queue_is_full():
+    pool = UploadPool(workers=1, queue_depth=1)
+    release = threading.Event()
+    pool.submit(release.wait)
+    pool.submit(release.wait)
+    submitted = threading.Event()
+
+    def submit():
+        pool.submit(lambda: None)
+        submitted.set()
+
+    thread = threading.Thread(target=submit)
+    thread.start()
+    # one batch is written and one waits, the third has to wait for a slot
+    assert not submitted.wait(0.2)
+    release.set()
+    assert submitted.wait(5)
+    thread.join()
+    pool.wait()
+    pool.shutdown()
+
+
+def test_upload_pool_raises_a_failed_upload_on_submit_and_wait():
+    pool = UploadPool(workers=1, queue_depth=0)
+
+    def fail():
+        raise ValueError("upload failed")
+
+    pool.submit(fail)
+    # the only slot is given back once the failure is recorded
+    with pool._slots:
+        pass
+    with pytest.raises(ValueError, match="upload failed"):
+        pool.submit(lambda: None)
+    with pytest.raises(ValueError, match="upload failed"):
+        pool.wait()
+    pool.shutdown()
+
+
+def test_end_of_pipe_shuts_the_upload_pool_down():
+    target = Targets3(config=test_core.SAMPLE_CONFIG)
+    pool = target.upload_pool
+
+    target._process_endofpipe()
+
+    assert target._upload_pool is None
+    with pytest.raises(RuntimeError):
+        pool.submit(lambda: None)
+
+
+@pytest.mark.parametrize("size", [0, 10])
+def test_multipart_writer_puts_small_objects_at_once(s3, size):
+    client = RecordingClient(s3)
+
+    with MultipartWriter(client, "bucket", "k", threshold=MIN_MULTIPART_PART_SIZE) as f:
+        f.write(b"x" * size)
+
+    assert client.calls == [("put_object", size)]
+    assert read(s3, "k") == b"x" * size
+
+
+def test_multipart_writer_uploads_parts_above_the_threshold(s3):
+    client = RecordingClient(s3)
+    data = bytes(range(256)) * (12 * MIB // 256)
+
+    with MultipartWriter(
+        client, "bucket", "k", part_size=5 * MIB, threshold=6 * MIB
+    ) as f:
+        for i in range(0, len(data), MIB):
+            f.write(data[i : i + MIB])
+        assert f.tell() == len(data)
+
+    parts = sorted(size for name, size in client.calls if name == "upload_part")
+    assert [name for name, _ in client.calls if name != "upload_part"] == [
+        "create_multipart_upload",
+        "complete_multipart_upload",
+    ]
+    assert parts == [2 * MIB, 5 * MIB, 5 * MIB]
+    assert read(s3, "k") == data
+
+
+@pytest.mark.parametrize("fail", [None, "upload_part"])
+def test_multipart_writer_aborts_a_failed_upload(s3, fail):
+    client = RecordingClient(s3, fail=fail)
+
+    with pytest.raises((ValueError, ConnectionError)):
+        with MultipartWriter(
+            client, "bucket", "k", part_size=5 * MIB, threshold=5 * MIB
+        ) as f:
+            f.write(b"x" * 6 * MIB)
+            if fail is None:
+                raise ValueError("serializing failed")
+
+    assert ("abort_multipart_upload", 0) in client.calls
+    assert "complete_multipart_upload" not in [name for name, _ in client.calls]
+    assert not s3.list_multipart_uploads(Bucket="bucket").get("Uploads")
+    assert not s3.list_objects_v2(Bucket="bucket").get("Contents")
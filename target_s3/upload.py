@@ -0,0 +1,234 @@
+"""Background uploads, lets the target keep reading while batches are written."""
+
+from __future__ import annotations
+
+import io
+import logging
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+LOGGER = logging.getLogger("target-s3")
+DEFAULT_UPLOAD_QUEUE_DEPTH = 2
+# S3 rejects parts, other than the last one, smaller than 5 MiB
+MIN_MULTIPART_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_MULTIPART_PART_SIZE = 16 * 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+DEFAULT_MULTIPART_CONCURRENCY = 4
+
+
+class UploadPool:
+    """A bounded pool of workers that serialize and upload batches.
+
+    At most `workers` batches are written at once and at most `queue_depth`
+    more wait for a free worker. Once both are taken `submit` blocks, which
+    stops the target from reading more input until an upload finishes.
+    """
+
+    def __init__(self, workers: int, queue_depth: int) -> None:
+        assert workers > 0, "UploadPool.__init__: Expecting at least one worker."
+        assert (
+            queue_depth >= 0
+        ), "UploadPool.__init__: Expecting a positive queue depth."
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="target-s3-upload"
+        )
+        self._slots = threading.BoundedSemaphore(workers + queue_depth)
+        self._lock = threading.Lock()
+        self._pending: set[Future] = set()
+        self._errors: list[BaseException] = []
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        """Queue `fn` for a worker, blocking while the queue is full."""
+        self.raise_for_errors()
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+            if not future.cancelled() and future.exception() is not None:
+                self._errors.append(future.exception())
+        self._slots.release()
+
+    def wait(self, futures: list[Future] | None = None) -> None:
+        """Block until the given (default: all pending) uploads are finished.
+
+        Raises the first error of any failed upload.
+        """
+        if futures is None:
+            with self._lock:
+                futures = list(self._pending)
+        wait(futures)
+        # done callbacks may still be running, so check the futures themselves
+        for future in futures:
+            if not future.cancelled() and future.exception() is not None:
+                raise future.exception()
+        self.raise_for_errors()
+
+    def raise_for_errors(self) -> None:
+        """Re-raise the first error of a failed upload, if any."""
+        with self._lock:
+            if self._errors:
+                raise self._errors[0]
+
+    def shutdown(self) -> None:
+        """Wait for all uploads and stop the workers."""
+        self._executor.shutdown(wait=True)
+
+
+class MultipartWriter(io.BufferedIOBase):
+    """A writable file object that uploads to S3 in parallel parts.
+
+    Objects smaller than `threshold` are sent with a single PUT. Larger ones
+    become a multipart upload of `part_size` parts, with up to `concurrency`
+    parts in flight at once; writing blocks while all of them are busy, so
+    at most `concurrency + 1` parts are held in memory.
+    """
+
+    def __init__(
+        self,
+        client,
+        bucket: str,
+        key: str,
+        part_size: int = DEFAULT_MULTIPART_PART_SIZE,
+        threshold: int = DEFAULT_MULTIPART_THRESHOLD,
+        concurrency: int = DEFAULT_MULTIPART_CONCURRENCY,
+    ) -> None:
+        super().__init__()
+        assert part_size >= MIN_MULTIPART_PART_SIZE, (
+            f"MultipartWriter.__init__: Expecting a part size of at least "
+            f"{MIN_MULTIPART_PART_SIZE} bytes."
+        )
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = part_size
+        self.threshold = max(threshold, part_size)
+        self.concurrency = concurrency
+        self._buffer = bytearray()
+        self._position = 0
+        # time callers spent in write and close, i.e. waiting on the upload
+        self.busy_seconds = 0.0
+        self._upload_id = None
+        self._executor = None
+        self._slots = threading.BoundedSemaphore(concurrency)
+        self._parts: list[Future] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def write(self, b) -> int:
+        start = time.perf_counter()
+        try:
+            return self._write(b)
+        finally:
+            self.busy_seconds += time.perf_counter() - start
+
+    def _write(self, b) -> int:
+        if self.closed:
+            raise ValueError("write to closed file")
+        self._buffer += b
+        self._position += len(b)
+        if self._upload_id is None and len(self._buffer) >= self.threshold:
+            self._upload_id = self.client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.concurrency, thread_name_prefix="target-s3-part"
+            )
+        if self._upload_id is not None:
+            while len(self._buffer) >= self.part_size:
+                self._upload_part(bytes(self._buffer[: self.part_size]))
+                del self._buffer[: self.part_size]
+        return len(b)
+
+    def _upload_part(self, body: bytes) -> None:
+        # fail early instead of uploading more parts of a broken object
+        for part in self._parts:
+            if part.done() and part.exception() is not None:
+                raise part.exception()
+        self._slots.acquire()
+        part_number = len(self._parts) + 1
+        future = self._executor.submit(self._send_part, part_number, body)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._parts.append(future)
+
+    def _send_part(self, part_number: int, body: bytes) -> dict:
+        response = self.client.upload_part(
+            Bucket=self.bucket,
+            Key=self.key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body,
+        )
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # never complete an object whose writer failed half way
+        if exc_type is not None:
+            self.terminate()
+        else:
+            self.close()
+
+    def close(self) -> None:
+        """Send what is left and complete the object."""
+        if self.closed:
+            return
+        start = time.perf_counter()
+        try:
+            if self._upload_id is None:
+                self.client.put_object(
+                    Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer)
+                )
+            else:
+                if self._buffer or not self._parts:
+                    self._upload_part(bytes(self._buffer))
+                parts = [part.result() for part in self._parts]
+                self.client.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": parts},
+                )
+        except BaseException:
+            self.abort()
+            raise
+        finally:
+            self._buffer = bytearray()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            super().close()
+            self.busy_seconds += time.perf_counter() - start
+
+    def terminate(self) -> None:
+        """Close without writing the object."""
+        if self.closed:
+            return
+        self._buffer = bytearray()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+        self.abort()
+        super().close()
+
+    def abort(self) -> None:
+        """Drop a started multipart upload so no parts are left behind."""
+        if self._upload_id is None:
+            return
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self._upload_id
+            )
+        except Exception as e:
+            LOGGER.warning(f"failed to abort multipart upload of {self.key}: {e}")